@@ -0,0 +1,835 @@
+"""
+I/O helpers shared by rank-bitext.py and dynamic-data-selection.py
+"""
+
+# imports
+import os, io, mmap, struct, hashlib, itertools, tempfile, shutil, subprocess, gzip, atexit
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INDEX_SUFFIX = ".idx.npy"
+TOKENS_SUFFIX = ".tok.npy"
+SCAN_CHUNK   = 1 << 24
+GATHER_BLOCK = 1 << 18
+WRITE_BUFFER = 1 << 22
+
+# binary score files: 64-byte header (magic, version, dtype code, count,
+# min, max, hash of the source files) followed by the raw scores
+SCORE_SUFFIX  = ".bin"
+SCORE_MAGIC   = b"DDSSCORE"
+SCORE_VERSION = 1
+SCORE_HEADER  = struct.Struct("<8sHc5xQdd16s8x")
+SCORE_DTYPES  = {b"f": numpy.dtype(numpy.float32), b"d": numpy.dtype(numpy.float64)}
+
+# tmpfs-backed directory for arrays shared between worker processes
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# compressed files are recognized by their extension
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+# compression threads shared by all outputs that are written at the same time
+COMPRESSION_THREADS = os.cpu_count() or 1
+
+# decompressed copies of compressed bitext files made by this process, by
+# (path, modification time), and the temporary directories holding them (by
+# parent directory), which are removed at exit
+DECOMPRESSED      = {}
+DECOMPRESSED_DIRS = {}
+
+
+# functions
+def compression_of(path):
+    """
+    Returns "gzip" or "zstd" for compressed files (by extension), else None.
+    """
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if path.endswith(suffix):
+            return compression
+    if path.endswith(".zstd"):
+        return "zstd"
+    return None
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise ImportError("Reading or writing .zst files requires the zstandard package " +
+                          "(pip install zstandard)")
+
+
+def open_input(path):
+    """
+    Opens a file for binary reading, decompressing .gz and .zst files on
+    the fly.
+    """
+    compression = compression_of(path)
+    if compression == "gzip":
+        return gzip.open(path, "rb")
+    if compression == "zstd":
+        require_zstandard()
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        return io.BufferedReader(reader, WRITE_BUFFER)
+    return open(path, "rb")
+
+
+def decompressed_path(path, tmp_dir=None):
+    """
+    Returns path for uncompressed files. A compressed file is decompressed
+    once per process to a temporary file in tmp_dir (default: system temp
+    directory), whose path is returned from then on, so that it can be
+    memory-mapped, indexed and passed to worker processes.
+    """
+    if not compression_of(path):
+        return path
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key not in DECOMPRESSED:
+        if tmp_dir not in DECOMPRESSED_DIRS:
+            DECOMPRESSED_DIRS[tmp_dir] = tempfile.mkdtemp(prefix="dds-bitext.", dir=tmp_dir)
+            atexit.register(shutil.rmtree, DECOMPRESSED_DIRS[tmp_dir], True)
+        # named like the file without its compression suffix
+        name = os.path.basename(output_path(path, "", "none"))
+        handle, decompressed = tempfile.mkstemp(dir=DECOMPRESSED_DIRS[tmp_dir], prefix=name + ".")
+        with os.fdopen(handle, "wb") as outfile, open_input(path) as infile:
+            shutil.copyfileobj(infile, outfile, SCAN_CHUNK)
+        DECOMPRESSED[key] = decompressed
+    return DECOMPRESSED[key]
+
+
+class PipeOutput(object):
+    """
+    File-like object that writes to a file through a compressor process,
+    e.g. pigz for multi-threaded gzip compression.
+    """
+    def __init__(self, command, path, buffer_size=WRITE_BUFFER):
+        self.outfile = open(path, "wb")
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.outfile,
+                                        bufsize=buffer_size)
+
+    def write(self, data):
+        return self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        return_code = self.process.wait()
+        self.outfile.close()
+        if return_code:
+            raise IOError("Compressor exited with code %d" %return_code)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def output_path(path, suffix="", compression=None):
+    """
+    Path of an output file derived from path, e.g. train.src.gz with suffix
+    ".ranked" becomes train.src.ranked.gz. The output is compressed like the
+    input unless compression is given ("none", "gzip" or "zstd").
+    """
+    input_compression = compression_of(path)
+    if input_compression:
+        path = path[:path.rindex(".")]
+    if compression is None:
+        compression = input_compression
+    if compression and compression != "none":
+        return path + suffix + COMPRESSION_SUFFIXES[compression]
+    return path + suffix
+
+
+def compression_threads(num_outputs):
+    """
+    Number of compression threads per output when num_outputs files are
+    written at the same time, splitting COMPRESSION_THREADS between them.
+    """
+    return max(1, COMPRESSION_THREADS // max(1, num_outputs))
+
+
+def open_output(path, threads=None, buffer_size=WRITE_BUFFER):
+    """
+    Opens an output file in binary mode with a large write buffer. .gz and
+    .zst files are compressed on the fly with threads compression threads
+    (default: COMPRESSION_THREADS).
+    """
+    if threads is None:
+        threads = COMPRESSION_THREADS
+    compression = compression_of(path)
+    if compression == "zstd":
+        require_zstandard()
+        compressor = zstandard.ZstdCompressor(threads=threads if threads > 1 else 0)
+        writer     = compressor.stream_writer(open(path, "wb"), closefd=True)
+        return io.BufferedWriter(writer, buffer_size)
+    if compression == "gzip":
+        pigz = shutil.which("pigz")
+        if pigz:
+            return PipeOutput([pigz, "-c", "-p", str(threads)], path, buffer_size)
+        return io.BufferedWriter(gzip.open(path, "wb", compresslevel=6), buffer_size)
+    return open(path, "wb+", buffering=buffer_size)
+
+
+def iter_line_starts(path):
+    """
+    Scans a file once and yields uint64 arrays with the byte offsets of its
+    line starts, followed by the file size (so line i spans
+    offsets[i]:offsets[i+1]).
+    """
+    yield numpy.zeros(1, dtype=numpy.uint64)
+    position = 0
+    last     = b"\n"
+    with open(path, "rb") as infile:
+        while True:
+            chunk = infile.read(SCAN_CHUNK)
+            if not chunk:
+                break
+            newlines = numpy.flatnonzero(numpy.frombuffer(chunk, dtype=numpy.uint8) == 10)
+            yield (newlines + position + 1).astype(numpy.uint64)
+            position += len(chunk)
+            last      = chunk[-1:]
+    # a last line without trailing newline still counts as a line
+    if last != b"\n":
+        yield numpy.array([position], dtype=numpy.uint64)
+
+
+def build_line_index(path):
+    """
+    Returns the line index of a file as an in-memory uint64 array.
+    """
+    return numpy.concatenate(list(iter_line_starts(path)))
+
+
+def load_line_index(path):
+    """
+    Returns the line index of a file, memory-mapped from the cached
+    <path>.idx.npy when it is newer than the file. Otherwise the index is
+    rebuilt, streaming it to the cache so that it never has to fit in memory.
+    """
+    index_file = path + INDEX_SUFFIX
+    if os.path.exists(index_file) and \
+       os.path.getmtime(index_file) >= os.path.getmtime(path):
+        offsets = numpy.load(index_file, mmap_mode="r")
+        if len(offsets) and offsets[-1] == os.path.getsize(path):
+            return offsets
+
+    tmp_files = []
+    try:
+        # built under unique names and moved into place, so that processes
+        # indexing the same file never see each other's partial index
+        raw_file   = temp_file_for(index_file, ".raw", tmp_files)
+        tmp_index  = temp_file_for(index_file, ".npy", tmp_files)
+        num_offsets = 0
+        with open(raw_file, "wb") as raw:
+            for starts in iter_line_starts(path):
+                starts.tofile(raw)
+                num_offsets += len(starts)
+        offsets = numpy.lib.format.open_memmap(tmp_index, mode="w+", dtype=numpy.uint64,
+                                               shape=(num_offsets,))
+        for start in range(0, num_offsets, SCAN_CHUNK):
+            count = min(SCAN_CHUNK, num_offsets - start)
+            offsets[start:start + count] = numpy.fromfile(raw_file, dtype=numpy.uint64,
+                                                          count=count, offset=8 * start)
+        offsets.flush()
+        del offsets
+        os.replace(tmp_index, index_file)
+        return numpy.load(index_file, mmap_mode="r")
+    except OSError:
+        # read-only corpus directory, use the index without caching
+        return build_line_index(path)
+    finally:
+        for tmp_file in tmp_files:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+def temp_file_for(path, suffix, tmp_files):
+    """
+    Creates a uniquely named temporary file next to path, to be moved onto
+    path with os.replace, and appends its name to tmp_files.
+    """
+    handle, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                        prefix=os.path.basename(path) + ".", suffix=suffix)
+    os.close(handle)
+    tmp_files.append(tmp_file)
+    return tmp_file
+
+
+def count_lines(path):
+    """
+    Number of lines of a file, from its line index or, for compressed
+    files that have not been decompressed yet, by streaming through the
+    decompressed data.
+    """
+    if not compression_of(path) or \
+       (os.path.abspath(path), os.path.getmtime(path)) in DECOMPRESSED:
+        return len(load_line_index(decompressed_path(path))) - 1
+    num_lines = 0
+    last      = b"\n"
+    with open_input(path) as infile:
+        while True:
+            chunk = infile.read(SCAN_CHUNK)
+            if not chunk:
+                break
+            num_lines += chunk.count(b"\n")
+            last       = chunk[-1:]
+    return num_lines + (0 if last == b"\n" else 1)
+
+
+def count_line_tokens(buffer, offsets):
+    """
+    Counts the whitespace-separated tokens of every line in a buffer with
+    the given line index. The buffer is scanned in chunks of whole lines,
+    in which token starts (non-space bytes after a space or a line start)
+    are found and counted per line without a Python loop over the lines.
+    """
+    num_lines = len(offsets) - 1
+    counts    = numpy.zeros(max(num_lines, 0), dtype=numpy.uint32)
+    if num_lines <= 0:
+        return counts
+    data       = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    first_line = 0
+    while first_line < num_lines:
+        start     = int(offsets[first_line])
+        last_line = int(numpy.searchsorted(offsets, start + SCAN_CHUNK, side="right")) - 1
+        last_line = min(max(last_line, first_line + 1), num_lines)
+        chunk     = data[start:int(offsets[last_line])]
+        is_space  = (chunk == 32) | (chunk == 9) | (chunk == 10) | (chunk == 13)
+        is_start  = ~is_space
+        is_start[1:] &= is_space[:-1]
+        line_starts = numpy.asarray(offsets[first_line:last_line + 1], dtype=numpy.int64)
+        token_lines = numpy.searchsorted(line_starts, numpy.flatnonzero(is_start) + start,
+                                         side="right") - 1
+        counts[first_line:last_line] = numpy.bincount(token_lines,
+                                                      minlength=last_line - first_line)
+        first_line = last_line
+    return counts
+
+
+def load_token_counts(path):
+    """
+    Returns the number of whitespace-separated tokens of every line of a
+    file, memory-mapped from the cached <path>.tok.npy if it is up to date.
+    """
+    path        = decompressed_path(path)
+    offsets     = load_line_index(path)
+    tokens_file = path + TOKENS_SUFFIX
+    if os.path.exists(tokens_file) and \
+       os.path.getmtime(tokens_file) >= os.path.getmtime(path):
+        counts = numpy.load(tokens_file, mmap_mode="r")
+        if len(counts) == len(offsets) - 1:
+            return counts
+
+    counts    = count_line_tokens(open_mmap(path), offsets)
+    tmp_files = []
+    try:
+        tmp_tokens = temp_file_for(tokens_file, ".npy", tmp_files)
+        numpy.save(tmp_tokens, counts)
+        os.replace(tmp_tokens, tokens_file)
+    except OSError:
+        # read-only corpus directory, use the counts without caching
+        pass
+    finally:
+        for tmp_file in tmp_files:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    return counts
+
+
+def open_mmap(path):
+    """
+    Memory-maps a file read-only. Empty files are returned as empty bytes.
+    """
+    if os.path.getsize(path) == 0:
+        return b""
+    with open(path, "rb") as infile:
+        return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class PackedLines(object):
+    """
+    Sentences packed into one contiguous buffer (bytes or a memory-mapped
+    file) plus a uint64 array of line offsets, so that line i spans
+    buffer[offsets[i]:offsets[i+1]]. Slicing and gather return views on the
+    same buffer; lines are returned as bytes and never decoded.
+    """
+    def __init__(self, buffer, offsets, line_numbers=None):
+        self.buffer       = buffer
+        self.offsets      = offsets
+        self.line_numbers = line_numbers
+
+    @classmethod
+    def open(cls, path, offsets=None):
+        """
+        Memory-maps a file with one sentence per line, using its line index.
+        Compressed files are memory-mapped from their decompressed copy (see
+        decompressed_path).
+        """
+        path = decompressed_path(path)
+        if offsets is None:
+            offsets = load_line_index(path)
+        return cls(open_mmap(path), offsets)
+
+    @classmethod
+    def from_lines(cls, lines):
+        """
+        Packs a list of lines (bytes) into a new in-memory store.
+        """
+        lengths = numpy.fromiter((len(line) for line in lines), dtype=numpy.uint64,
+                                 count=len(lines))
+        offsets = numpy.concatenate((numpy.zeros(1, dtype=numpy.uint64), numpy.cumsum(lengths)))
+        return cls(b"".join(lines), offsets.astype(numpy.uint64))
+
+    def __len__(self):
+        if self.line_numbers is None:
+            return len(self.offsets) - 1
+        return len(self.line_numbers)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if self.line_numbers is None:
+                start, stop, step = key.indices(len(self))
+                if step == 1:
+                    return PackedLines(self.buffer, self.offsets[start:max(start, stop) + 1])
+                return PackedLines(self.buffer, self.offsets, numpy.arange(start, stop, step))
+            return PackedLines(self.buffer, self.offsets, self.line_numbers[key])
+        line_nr = key if self.line_numbers is None else self.line_numbers[key]
+        return self.buffer[int(self.offsets[line_nr]):int(self.offsets[line_nr + 1])]
+
+    def gather(self, indices):
+        """
+        Returns a view with the lines at the given positions, in that order.
+        """
+        indices = numpy.asarray(indices)
+        if self.line_numbers is None:
+            return PackedLines(self.buffer, self.offsets, indices)
+        return PackedLines(self.buffer, self.offsets, numpy.asarray(self.line_numbers)[indices])
+
+    def iter_blocks(self, block_size=GATHER_BLOCK):
+        """
+        Yields lists with the lines (newline-terminated bytes) in blocks of
+        block_size lines: each block is read in buffer order, reordered in
+        memory and yielded, after which its pages are released again.
+        """
+        for block_start in range(0, len(self), block_size):
+            if self.line_numbers is None:
+                # lines in buffer order are read as they are
+                bounds = self.offsets[block_start:block_start + block_size + 1].tolist()
+                lines  = [self.buffer[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+                yield [line if line.endswith(b"\n") else line + b"\n" for line in lines]
+            else:
+                block      = numpy.asarray(self.line_numbers[block_start:block_start + block_size])
+                read_order = numpy.argsort(block, kind="stable")
+                starts     = self.offsets[block[read_order]].tolist()
+                ends       = self.offsets[block[read_order] + 1].tolist()
+                lines      = [None] * len(block)
+                for position, start, end in zip(read_order.tolist(), starts, ends):
+                    line = self.buffer[start:end]
+                    lines[position] = line if line.endswith(b"\n") else line + b"\n"
+                yield lines
+            if isinstance(self.buffer, mmap.mmap) and hasattr(mmap, "MADV_DONTNEED"):
+                self.buffer.madvise(mmap.MADV_DONTNEED)
+
+    def __iter__(self):
+        for lines in self.iter_blocks():
+            for line in lines:
+                yield line
+
+    def write(self, outfile, block_size=GATHER_BLOCK):
+        """
+        Writes all lines to outfile (opened in binary mode).
+        """
+        for lines in self.iter_blocks(block_size):
+            outfile.write(b"".join(lines))
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+
+def copy_prefix(path, outfile_name, num_bytes):
+    """
+    Copies the first num_bytes of path to outfile_name inside the kernel
+    with os.copy_file_range, which also shares extents (reflinks) on
+    filesystems that support it, falling back to os.sendfile and finally
+    to a buffered copy.
+    """
+    with open(path, "rb") as infile, open(outfile_name, "wb+") as outfile:
+        copied = 0
+        for kernel_copy in ("copy_file_range", "sendfile"):
+            if not hasattr(os, kernel_copy):
+                continue
+            try:
+                while copied < num_bytes:
+                    if kernel_copy == "copy_file_range":
+                        count = os.copy_file_range(infile.fileno(), outfile.fileno(),
+                                                   num_bytes - copied, copied, copied)
+                    else:
+                        count = os.sendfile(outfile.fileno(), infile.fileno(), copied,
+                                            num_bytes - copied)
+                    if count == 0:
+                        break
+                    copied += count
+                return
+            except OSError:
+                # not supported for this pair of files, e.g. across filesystems;
+                # continue after the bytes that were copied
+                outfile.seek(copied)
+        infile.seek(copied)
+        outfile.seek(copied)
+        remaining = num_bytes - copied
+        while remaining > 0:
+            chunk = infile.read(min(remaining, SCAN_CHUNK))
+            if not chunk:
+                break
+            outfile.write(chunk)
+            remaining -= len(chunk)
+
+
+def iter_prefix_lines(path, num_bytes):
+    """
+    Yields the lines (newline-terminated bytes) in the first num_bytes of an
+    uncompressed file, reading it sequentially without a line index.
+    Raises ValueError if num_bytes does not end at a line boundary.
+    """
+    remaining = num_bytes
+    with open(path, "rb", buffering=WRITE_BUFFER) as infile:
+        while remaining > 0:
+            line       = infile.readline(remaining)
+            remaining -= len(line)
+            if not line.endswith(b"\n"):
+                # only the last line of the file may lack a newline
+                if not line or infile.read(1):
+                    raise ValueError("File %s does not have a line boundary at byte %d"
+                                     %(path, num_bytes))
+                line += b"\n"
+            yield line
+
+
+def write_permutation(path, sorted_sent_ids, num_sentences=None):
+    """
+    Saves the ranking as a .npy array of sentence ids below num_sentences
+    (default: the number of ids), using uint32 when all ids fit and uint64
+    otherwise.
+    """
+    num_ids = len(sorted_sent_ids)
+    if num_sentences is None:
+        num_sentences = num_ids
+    dtype   = numpy.uint32 if num_sentences <= 2 ** 32 else numpy.uint64
+    permutation = numpy.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(num_ids,))
+    for start in range(0, num_ids, SCAN_CHUNK):
+        permutation[start:start + SCAN_CHUNK] = sorted_sent_ids[start:start + SCAN_CHUNK]
+    permutation.flush()
+
+
+def load_permutation(path):
+    """
+    Memory-maps a permutation written by write_permutation.
+    """
+    return numpy.load(path, mmap_mode="r")
+
+
+def open_ranked_store(bitext_file, permutation=None):
+    """
+    Opens a ranked bitext file as a PackedLines store, or an unranked one as
+    a view in the order given by a permutation.
+    """
+    store = PackedLines.open(bitext_file)
+    if permutation is None:
+        return store
+    # a permutation written with --top_k/--keep_fraction only covers the head
+    if len(permutation) > len(store):
+        raise ValueError("Bitext file %s has %d lines, but the permutation has %d entries"
+                         %(bitext_file, len(store), len(permutation)))
+    return store.gather(permutation)
+
+
+def iter_ranked_lines(bitext_file, permutation, start=0, stop=None):
+    """
+    Streams the lines of an unranked bitext file in ranked order, i.e. line
+    permutation[i] for i in range(start, stop), as newline-terminated bytes.
+    """
+    return iter(open_ranked_store(bitext_file, permutation)[start:stop])
+
+
+def source_hash(*paths):
+    """
+    Fingerprints files by path, size and modification time, so that a
+    binary score file can be matched against the files it was made from.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(("%s:%d:%d;" %(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).encode())
+    return digest.digest()
+
+
+def read_score_header(path):
+    """
+    Returns the header of a binary score file as a dict, or None if path is
+    not a binary score file.
+    """
+    with open(path, "rb") as infile:
+        header = infile.read(SCORE_HEADER.size)
+    if len(header) < SCORE_HEADER.size or not header.startswith(SCORE_MAGIC):
+        return None
+    magic, version, dtype, count, min_score, max_score, source = SCORE_HEADER.unpack(header)
+    if version != SCORE_VERSION or dtype not in SCORE_DTYPES:
+        raise ValueError("Unsupported binary score file %s" %path)
+    return {"dtype": SCORE_DTYPES[dtype], "count": count, "min": min_score,
+            "max": max_score, "source_hash": source}
+
+
+def write_scores(path, scores, source=b"", dtype=numpy.float32):
+    """
+    Writes scores (an array, or an iterable of array blocks) to a binary
+    score file. source is the source_hash of the files the scores are
+    derived from.
+    """
+    if isinstance(scores, numpy.ndarray):
+        scores = [scores]
+    dtype      = numpy.dtype(dtype)
+    dtype_code = [code for code, code_dtype in SCORE_DTYPES.items() if code_dtype == dtype][0]
+    count      = 0
+    min_score  = numpy.inf
+    max_score  = -numpy.inf
+    with open(path, "wb+") as outfile:
+        outfile.write(b"\0" * SCORE_HEADER.size)
+        for block in scores:
+            block = numpy.asarray(block, dtype=dtype)
+            if len(block):
+                min_score = min(min_score, float(block.min()))
+                max_score = max(max_score, float(block.max()))
+            block.tofile(outfile)
+            count += len(block)
+        outfile.seek(0)
+        outfile.write(SCORE_HEADER.pack(SCORE_MAGIC, SCORE_VERSION, dtype_code, count,
+                                        min_score, max_score, source))
+
+
+def map_scores(path, header):
+    """
+    Memory-maps the scores of a binary score file.
+    """
+    if header["count"] == 0:
+        return numpy.empty(0, dtype=header["dtype"])
+    return numpy.memmap(path, dtype=header["dtype"], mode="r", offset=SCORE_HEADER.size,
+                        shape=(header["count"],))
+
+
+def cached_score_file(path, dtype):
+    """
+    Returns the path of the binary cache <path>.bin of a text score file if
+    it exists, holds dtype scores and matches the current text file.
+    """
+    cache_file = path + SCORE_SUFFIX
+    if os.path.exists(cache_file):
+        header = read_score_header(cache_file)
+        if header and header["dtype"] == numpy.dtype(dtype) and \
+           header["source_hash"] == source_hash(path):
+            return cache_file
+    return None
+
+
+def load_scores(path, dtype=numpy.float64, cache=False):
+    """
+    Loads a score file into a 1-d array. Binary score files and valid binary
+    caches are memory-mapped; text files with exactly one score per line are
+    parsed (blank lines are rejected, as they would shift all later scores),
+    and with cache=True converted to a binary cache <path>.bin for next time.
+    """
+    header = read_score_header(path)
+    if header:
+        return map_scores(path, header)
+    cache_file = cached_score_file(path, dtype)
+    if cache_file:
+        return map_scores(cache_file, read_score_header(cache_file))
+
+    chunks = list(iter_text_scores(path, dtype))
+    scores = numpy.concatenate(chunks) if chunks else numpy.empty(0, dtype=dtype)
+    if cache:
+        write_scores(path + SCORE_SUFFIX, scores, source_hash(path), dtype)
+    return scores
+
+
+def split_at_newlines(path, num_chunks):
+    """
+    Splits a file into at most num_chunks byte ranges (start, end) that
+    each end at a line boundary.
+    """
+    file_size  = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, "rb") as infile:
+        for i in range(1, num_chunks):
+            position = max(file_size * i // num_chunks, boundaries[-1])
+            infile.seek(position)
+            infile.readline()   # move to the start of the next line
+            boundaries.append(min(infile.tell(), file_size))
+    boundaries.append(file_size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def count_chunk_lines(path, start, end):
+    """
+    Counts the lines in a byte range of a file.
+    """
+    with open(path, "rb") as infile:
+        infile.seek(start)
+        chunk = infile.read(end - start)
+    return chunk.count(b"\n") + (0 if chunk.endswith(b"\n") else 1)
+
+
+def parse_score_text(text, dtype, path):
+    """
+    Parses a chunk of whole lines of a text score file (bytes) with one
+    score per line into an array, without splitting it into Python strings.
+    """
+    if not text:
+        return numpy.empty(0, dtype=dtype)
+    # every line holds exactly one token if token starts and newlines
+    # alternate; numpy.fromstring itself would skip blank lines
+    data      = numpy.frombuffer(text, dtype=numpy.uint8)
+    is_space  = data <= 32    # whitespace and control characters
+    is_start  = ~is_space
+    is_start[1:] &= is_space[:-1]
+    starts    = numpy.flatnonzero(is_start)
+    newlines  = numpy.flatnonzero(data == 10)
+    num_lines = len(newlines) + (0 if text.endswith(b"\n") else 1)
+    if not (len(starts) == num_lines and
+            numpy.all(starts[:len(newlines)] < newlines) and
+            numpy.all(newlines[:num_lines - 1] < starts[1:])):
+        raise ValueError("Score file %s contains lines without exactly one score" %path)
+    scores = numpy.fromstring(text, dtype=dtype, sep=" ")
+    if not len(scores) == num_lines:
+        raise ValueError("Score file %s contains lines without exactly one score" %path)
+    return scores
+
+
+def iter_text_scores(path, dtype=numpy.float64, chunk_size=SCAN_CHUNK):
+    """
+    Yields the scores of a (possibly compressed) text score file as arrays,
+    reading it in chunks of about chunk_size bytes that are cut at the last
+    newline.
+    """
+    partial = b""
+    with open_input(path) as infile:
+        while True:
+            chunk = infile.read(chunk_size)
+            if not chunk:
+                break
+            chunk   = partial + chunk
+            cut     = chunk.rfind(b"\n") + 1
+            partial = chunk[cut:]
+            yield parse_score_text(chunk[:cut], dtype, path)
+    # a last line without trailing newline
+    if partial:
+        yield parse_score_text(partial, dtype, path)
+
+
+def parse_chunk_scores(path, start, end, shared_file, dtype, first_line, num_lines):
+    """
+    Parses the scores in a byte range of a text score file into lines
+    first_line:first_line+num_lines of an array in a shared file.
+    """
+    with open(path, "rb") as infile:
+        infile.seek(start)
+        chunk = infile.read(end - start)
+    scores = parse_score_text(chunk, dtype, path)
+    if not len(scores) == num_lines:
+        raise ValueError("Score file %s contains lines without exactly one score" %path)
+    target = numpy.memmap(shared_file, dtype=dtype, mode="r+", shape=(num_lines,),
+                          offset=first_line * numpy.dtype(dtype).itemsize)
+    target[:] = scores
+    target.flush()
+
+
+def load_scores_parallel(paths, dtype=numpy.float64, cache=False, workers=1):
+    """
+    Loads several score files of the same length, parsing text files
+    chunk-wise in a pool of worker processes.
+    """
+    dtype = numpy.dtype(dtype)
+    if workers <= 1:
+        scores = [load_scores(path, dtype, cache) for path in paths]
+        if len(set(len(s) for s in scores)) > 1:
+            raise ValueError("Score files do not have the same number of lines (%s)"
+                             %", ".join(str(len(s)) for s in scores))
+        return scores
+
+    # compressed files cannot be split at byte offsets and are parsed serially
+    text_files = [path for path in paths if not read_score_header(path)
+                  and not cached_score_file(path, dtype) and not compression_of(path)]
+    with ProcessPoolExecutor(workers) as pool:
+        chunks = dict((path, split_at_newlines(path, 4 * workers)) for path in text_files)
+        counts = {}
+        for path in text_files:
+            counts[path] = list(pool.map(count_chunk_lines, itertools.repeat(path),
+                                         *zip(*chunks[path]))) if chunks[path] else []
+        loaded    = dict((path, load_scores(path, dtype, cache)) for path in paths
+                         if path not in counts)
+        num_lines = [sum(counts[path]) if path in counts else len(loaded[path])
+                     for path in paths]
+        if len(set(num_lines)) > 1:
+            raise ValueError("Score files do not have the same number of lines (%s)"
+                             %", ".join(str(n) for n in num_lines))
+
+        parsed = {}
+        for path in text_files:
+            if num_lines[0] == 0:
+                parsed[path] = numpy.empty(0, dtype=dtype)
+                continue
+            handle, shared_file = tempfile.mkstemp(prefix="dds-scores.", dir=SHARED_DIR)
+            try:
+                os.ftruncate(handle, num_lines[0] * dtype.itemsize)
+                os.close(handle)
+                first_lines = numpy.cumsum([0] + counts[path][:-1]).tolist()
+                jobs = [pool.submit(parse_chunk_scores, path, start, end, shared_file, dtype,
+                                    first_line, count)
+                        for (start, end), first_line, count in
+                        zip(chunks[path], first_lines, counts[path])]
+                for job in jobs:
+                    job.result()
+                # the mapping stays valid after the file is unlinked
+                parsed[path] = numpy.memmap(shared_file, dtype=dtype, mode="r+",
+                                            shape=(num_lines[0],))
+            finally:
+                os.remove(shared_file)
+            if cache:
+                write_scores(path + SCORE_SUFFIX, parsed[path], source_hash(path), dtype)
+
+    return [parsed[path] if path in parsed else loaded[path] for path in paths]
+
+
+def iter_score_blocks(path, block_size, dtype=numpy.float64, chunk_size=SCAN_CHUNK):
+    """
+    Yields the scores of a binary or text score file in blocks of block_size
+    (the last block may be shorter). Text files are read in chunks of about
+    chunk_size bytes, cut at the last newline and parsed with numpy, so that
+    memory use is bounded by block_size scores plus one chunk.
+    """
+    header = read_score_header(path)
+    cache_file = None if header else cached_score_file(path, dtype)
+    if header or cache_file:
+        scores = load_scores(path, dtype)
+        for start in range(0, len(scores), block_size):
+            yield numpy.asarray(scores[start:start + block_size], dtype=dtype)
+        return
+
+    # parsed chunks are copied into preallocated blocks, so that blocks are
+    # never concatenated
+    block  = numpy.empty(block_size, dtype=dtype)
+    filled = 0
+    for scores in iter_text_scores(path, dtype, chunk_size):
+        position = 0
+        while position < len(scores):
+            count = min(block_size - filled, len(scores) - position)
+            block[filled:filled + count] = scores[position:position + count]
+            filled   += count
+            position += count
+            if filled == block_size:
+                yield block
+                block  = numpy.empty(block_size, dtype=dtype)
+                filled = 0
+    if filled:
+        yield block[:filled]
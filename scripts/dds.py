@@ -0,0 +1,504 @@
+"""
+Dynamic data selection for NMT as an importable library
+Author: Marlies van der Wees
+For details, see paper 'Dynamic Data Selection for Neural Machine Translation'.
+
+Epochs are produced in-process, either as index arrays into the ranked
+bitext or as (src, trg) sentence pairs, e.g.:
+
+    import dds
+    for epoch_nr, pairs in dds.gradual_fine_tuning("train.src", "train.trg",
+                                                   0.5, 0.7, 2, 16):
+        for src, trg in pairs:
+            ...
+"""
+
+# imports
+import json, os, time
+import numpy
+from bitext_io import open_ranked_store, load_line_index, load_scores, load_permutation, \
+                      count_lines, compression_of, output_path, load_token_counts, \
+                      iter_prefix_lines
+
+
+# functions
+def normalize_weights(weights):
+    """
+    Invert and min-max normalize CED weights as in Eq 3.
+    """
+    weights      = numpy.asarray(weights, dtype=numpy.float64)
+    max_weight   = weights.max()
+    min_weight   = weights.min()
+    norm_weights = 1.0 - ((weights - min_weight) / (max_weight - min_weight))
+    return norm_weights
+
+
+def convert_weights_to_probabilities(weights):
+    """
+    Makes sure that the weights sum to 1 as in Eq 4.
+    """
+    weights     = numpy.asarray(weights, dtype=numpy.float64)
+    sum_weights = weights.sum()
+    return weights / sum_weights
+
+
+def count_ranked_lines(bitext_file, permutation=None):
+    """
+    Number of lines of a ranked bitext, without reading the lines.
+    """
+    if permutation is None:
+        return count_lines(bitext_file)
+    return len(permutation)
+
+
+def epoch_file(bitext_file, epoch_nr, compression=None):
+    """
+    Path of train.<ext>.epoch, with the extension of its compression.
+    """
+    return output_path(bitext_file, "." + str(epoch_nr), compression)
+
+
+def epoch_marker(bitext_src, epoch_nr, state):
+    """
+    Path of the marker file train.src.<epoch>.<state> through which the
+    producer (state "ready") and the trainer (state "done") coordinate.
+    """
+    return output_path(bitext_src, ".%d.%s" %(epoch_nr, state), "none")
+
+
+def bucket_file(bitext_src, epoch_nr):
+    """
+    Path of train.src.<epoch>.buckets, which lists the line numbers at which
+    the length buckets of a bucketed epoch start.
+    """
+    return output_path(bitext_src, ".%d.buckets" %epoch_nr, "none")
+
+
+def wait_for_epoch(bitext_src, epoch_nr, poll_interval=1.0):
+    """
+    Blocks until a producer started with --prefetch has written the
+    training files of an epoch.
+    """
+    while not os.path.exists(epoch_marker(bitext_src, epoch_nr, "ready")):
+        time.sleep(poll_interval)
+
+
+def release_epoch(bitext_src, epoch_nr):
+    """
+    Tells a producer started with --prefetch that the training files of an
+    epoch have been consumed and can be removed.
+    """
+    open(epoch_marker(bitext_src, epoch_nr, "done"), "w").close()
+
+
+def parse_epochs(spec, total_epochs):
+    """
+    Parses an epoch selection such as "9-16" or "1,3,5-7" into a sorted
+    list of epoch numbers in the range 1-total_epochs.
+    """
+    epochs = set()
+    for part in spec.split(","):
+        first, _, last = part.strip().partition("-")
+        first = int(first)
+        last  = int(last) if last else first
+        if not (1 <= first and first <= last and last <= total_epochs):
+            raise ValueError("Epochs %s are not in range 1-%d" %(part.strip(), total_epochs))
+        epochs.update(range(first, last + 1))
+    return sorted(epochs)
+
+
+def ranked_token_counts(bitext_src, bitext_trg, permutation=None):
+    """
+    Number of source plus target tokens of each sentence pair of the ranked
+    bitext.
+    """
+    counts = numpy.add(load_token_counts(bitext_src), load_token_counts(bitext_trg),
+                       dtype=numpy.uint64)
+    if permutation is not None:
+        counts = counts[permutation]
+    return counts
+
+
+def cumulative_token_counts(bitext_src, bitext_trg, permutation=None):
+    """
+    Cumulative number of source plus target tokens over the ranked bitext,
+    i.e. element i is the number of tokens in the top i+1 sentence pairs.
+    """
+    return numpy.cumsum(ranked_token_counts(bitext_src, bitext_trg, permutation),
+                        dtype=numpy.uint64)
+
+
+def gft_selection_sizes(num_lines, start_size, retention_rate, num_epochs, total_epochs,
+                        cumulative_tokens=None):
+    """
+    Number of top-ranked sentence pairs to keep per epoch according to Eq 5.
+    Given the cumulative token counts of the ranked bitext, Eq 5 is applied
+    to the number of tokens instead, and each epoch keeps the longest prefix
+    that fits in its token budget.
+    """
+    if cumulative_tokens is None:
+        return [int(num_lines * start_size * retention_rate ** (i/num_epochs))
+                for i in range(total_epochs)]
+    num_tokens = int(cumulative_tokens[-1]) if len(cumulative_tokens) else 0
+    budgets    = [int(num_tokens * start_size * retention_rate ** (i/num_epochs))
+                  for i in range(total_epochs)]
+    return numpy.searchsorted(cumulative_tokens, numpy.array(budgets, dtype=numpy.uint64),
+                              side="right").tolist()
+
+
+def gft_selections(num_lines, start_size, retention_rate, num_epochs, total_epochs,
+                   epochs=None, cumulative_tokens=None):
+    """
+    Yields (epoch_nr, selection) for gradual fine-tuning as described in
+    Sec 3, Eq 5, where selection holds the ranks of the selected sentence
+    pairs, for all epochs or only the given epoch numbers.
+    """
+    sizes = gft_selection_sizes(num_lines, start_size, retention_rate, num_epochs, total_epochs,
+                                cumulative_tokens)
+    for n in epochs or range(1, total_epochs+1):
+        yield n, numpy.arange(sizes[n - 1])
+
+
+def epoch_rng(seed, epoch_nr):
+    """
+    Random generator for one epoch, derived from seed as child epoch_nr-1
+    of numpy.random.SeedSequence(seed).spawn(), so that every epoch has an
+    independent stream that does not depend on the other epochs.
+    """
+    return numpy.random.default_rng(numpy.random.SeedSequence(seed, spawn_key=(epoch_nr - 1,)))
+
+
+def shuffle_epoch(selection, epoch_nr, seed):
+    """
+    Returns the selection of an epoch in a random order that only depends
+    on the seed and the epoch, drawn from a stream independent of the one
+    used to sample the epoch.
+    """
+    rng = numpy.random.default_rng(numpy.random.SeedSequence(seed, spawn_key=(epoch_nr - 1, 0)))
+    return rng.permutation(selection)
+
+
+def bucket_epoch(selection, lengths, bucket_width, epoch_nr, seed=None):
+    """
+    Orders the selection of an epoch into length buckets of bucket_width
+    tokens, short to long, each shuffled using the seed. Returns the ordered
+    selection and the bucket start positions, followed by the epoch size.
+    """
+    selection = numpy.asarray(selection)
+    if seed is None:
+        shuffled = selection[numpy.random.permutation(len(selection))]
+    else:
+        shuffled = shuffle_epoch(selection, epoch_nr, seed)
+    buckets   = numpy.asarray(lengths)[shuffled] // bucket_width
+    by_bucket = numpy.argsort(buckets, kind="stable")
+    starts    = numpy.flatnonzero(numpy.diff(buckets[by_bucket])) + 1
+    return shuffled[by_bucket], numpy.concatenate(([0], starts, [len(selection)]))
+
+
+def shard_bounds(num_lines, shard, num_shards):
+    """
+    Start and end of shard number shard (counting from 0) when num_lines
+    positions are split into num_shards disjoint, contiguous shards.
+    """
+    if not (0 <= shard and shard < num_shards):
+        raise ValueError("Shard %d is not in range 0-%d" %(shard, num_shards - 1))
+    return num_lines * shard // num_shards, num_lines * (shard + 1) // num_shards
+
+
+def check_probabilities(sample_probs, num_to_select=0):
+    """
+    Raises ValueError, like numpy.random.choice, if sample_probs contains
+    NaN or negative values (e.g. when all CED weights are equal, so that
+    they cannot be normalized) or has fewer than num_to_select non-zero
+    entries. Returns the number of non-zero entries.
+    """
+    if not numpy.all(sample_probs >= 0):
+        raise ValueError("Sampling probabilities contain NaN or negative values; " +
+                         "are all CED weights equal?")
+    num_positive = int(numpy.count_nonzero(sample_probs))
+    if num_to_select > num_positive:
+        raise ValueError("Cannot sample %d sentence pairs from %d with non-zero probability"
+                         %(num_to_select, num_positive))
+    return num_positive
+
+
+def weighted_sample(sample_probs, num_to_select, sampler="es", rng=None):
+    """
+    Draws num_to_select distinct indices with probabilities sample_probs,
+    using Efraimidis-Spirakis keys ("es") or numpy.random.choice ("numpy").
+    """
+    if rng is None:
+        rng = numpy.random
+    if sampler == "numpy":
+        return rng.choice(len(sample_probs), size=num_to_select, replace=False, p=sample_probs)
+    check_probabilities(sample_probs, num_to_select)
+    if num_to_select == 0:
+        return numpy.empty(0, dtype=numpy.int64)
+
+    # compare log(u)/p instead of u^(1/p); 1 - random() avoids log(0)
+    log_u = numpy.log(1.0 - rng.random(len(sample_probs)))
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        keys = numpy.where(sample_probs > 0, log_u / sample_probs, -numpy.inf)
+    return numpy.argpartition(-keys, num_to_select - 1)[:num_to_select]
+
+
+def weighted_sample_tokens(sample_probs, lengths, token_budget, sampler="es", rng=None):
+    """
+    Draws distinct indices with probabilities sample_probs until the next
+    draw would exceed token_budget, where lengths holds the number of tokens
+    of each index.
+    """
+    if rng is None:
+        rng = numpy.random
+    num_positive = check_probabilities(sample_probs)
+    if num_positive == 0 or token_budget <= 0:
+        return numpy.empty(0, dtype=numpy.int64)
+    lengths = numpy.asarray(lengths, dtype=numpy.uint64)
+
+    if sampler == "numpy":
+        order      = rng.choice(len(sample_probs), size=num_positive, replace=False,
+                                p=sample_probs)
+        cumulative = numpy.cumsum(lengths[order], dtype=numpy.uint64)
+        return order[:numpy.searchsorted(cumulative, token_budget, side="right")]
+
+    log_u = numpy.log(1.0 - rng.random(len(sample_probs)))
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        keys = numpy.where(sample_probs > 0, log_u / sample_probs, -numpy.inf)
+    # only the top keys are sorted: estimate the number of draws from the mean
+    # length and double it until the budget is exceeded
+    mean_length   = max(1.0, float(lengths.mean()))
+    num_to_select = min(num_positive, int(1.25 * token_budget / mean_length) + 1)
+    while True:
+        top        = numpy.argpartition(-keys, num_to_select - 1)[:num_to_select]
+        top        = top[numpy.argsort(-keys[top], kind="stable")]
+        cumulative = numpy.cumsum(lengths[top], dtype=numpy.uint64)
+        if cumulative[-1] > token_budget or num_to_select == num_positive:
+            return top[:numpy.searchsorted(cumulative, token_budget, side="right")]
+        num_to_select = min(num_positive, 2 * num_to_select)
+
+
+def sampling_token_budget(token_counts, start_size, samp_fraction):
+    """
+    Returns the token counts of the sentence pairs to sample from and the
+    number of tokens to draw per epoch: samp_fraction of all tokens of the
+    ranked bitext instead of samp_fraction of its sentence pairs.
+    """
+    select_from  = int(start_size * len(token_counts))
+    token_budget = int(samp_fraction * int(numpy.sum(token_counts, dtype=numpy.uint64)))
+    return token_counts[:select_from], token_budget
+
+
+def sampling_probabilities(weights, start_size, samp_fraction):
+    """
+    Returns the sampling probabilities of the top-ranked sentence pairs
+    (Eq 3 and 4) and the number of pairs to draw per epoch.
+    """
+    # absolute rather than relative hyperparam values, both relative to the
+    # ranked bitext that is read, which may only be the head of a ranking
+    select_from   = int(start_size * len(weights))
+    num_to_select = int(samp_fraction * len(weights))
+
+    # normalize weights
+    top_n_weights = weights[:select_from]
+    norm_weights  = normalize_weights(top_n_weights)
+    sample_probs  = convert_weights_to_probabilities(norm_weights)
+    return sample_probs, num_to_select
+
+
+def sample_epoch(sample_probs, num_to_select, epoch_nr, seed=None, sampler="es", lengths=None):
+    """
+    Returns the sorted ranks of the sentence pairs sampled for one epoch,
+    drawn from the epoch's own random stream if a seed is given. Given the
+    token counts of the candidates, num_to_select is a number of tokens.
+    """
+    rng = None if seed is None else epoch_rng(seed, epoch_nr)
+    if lengths is not None:
+        return numpy.sort(weighted_sample_tokens(sample_probs, lengths, num_to_select,
+                                                 sampler, rng))
+    return numpy.sort(weighted_sample(sample_probs, num_to_select, sampler, rng))
+
+
+def sampling_selections(weights, start_size, samp_fraction, total_epochs, sampler="es",
+                        seed=None, epochs=None, token_counts=None):
+    """
+    Yields (epoch_nr, selection) for sampling as described in Sec 3, Eq 3
+    and 4, where selection holds the sorted ranks of the sampled sentence
+    pairs. Limiting epochs to a list of epoch numbers requires a seed.
+    """
+    if epochs is not None and seed is None:
+        raise ValueError("Sampling a selection of epochs requires a seed")
+    sample_probs, num_to_select = sampling_probabilities(weights, start_size, samp_fraction)
+    lengths = None
+    if token_counts is not None:
+        lengths, num_to_select = sampling_token_budget(token_counts, start_size, samp_fraction)
+
+    # weighted sampling: draw n sentence pairs per epoch
+    for n in epochs or range(1, total_epochs+1):
+        yield n, sample_epoch(sample_probs, num_to_select, n, seed, sampler, lengths)
+
+
+def epoch_membership(selections, num_lines, total_epochs):
+    """
+    Packs epoch selections into a bitset with one row per sentence pair,
+    in which bit n-1 is set if the pair is selected in epoch n.
+    """
+    membership = numpy.zeros((num_lines, (total_epochs + 7) // 8), dtype=numpy.uint8)
+    for n, selection in selections:
+        membership[selection, (n - 1) // 8] |= numpy.uint8(1 << ((n - 1) % 8))
+    return membership
+
+
+def epoch_pairs(src_store, trg_store, selection=None, as_bytes=False):
+    """
+    Yields the (src, trg) sentence pairs of an epoch selection from two
+    PackedLines stores, or all pairs if no selection is given. Lines are
+    decoded from UTF-8, replacing invalid bytes, unless as_bytes is set.
+    """
+    if selection is not None:
+        src_store = src_store.gather(selection)
+        trg_store = trg_store.gather(selection)
+    return line_pairs(src_store, trg_store, as_bytes)
+
+
+def line_pairs(src_lines, trg_lines, as_bytes=False):
+    """
+    Yields (src, trg) sentence pairs from two iterables of lines (bytes),
+    decoded as in epoch_pairs unless as_bytes is set.
+    """
+    if as_bytes:
+        for pair in zip(src_lines, trg_lines):
+            yield pair
+    else:
+        for src_line, trg_line in zip(src_lines, trg_lines):
+            yield src_line.decode("utf-8", "replace"), trg_line.decode("utf-8", "replace")
+
+
+def open_sampling_inputs(bitext_src, bitext_trg, weights_file, permutation=None,
+                         cache_weights=False):
+    """
+    Opens the ranked bitext as PackedLines stores and loads the CED weights.
+    """
+    src_store     = open_ranked_store(bitext_src, permutation)
+    trg_store     = open_ranked_store(bitext_trg, permutation)
+    float_weights = load_scores(weights_file, cache=cache_weights)
+
+    assert(len(src_store) == len(trg_store) and len(trg_store) == len(float_weights))
+    return src_store, trg_store, float_weights
+
+
+def sample_training_data(bitext_src, bitext_trg, weights_file, start_size,
+                         samp_fraction, total_epochs, permutation=None, cache_weights=False,
+                         sampler="es", as_bytes=False, seed=None, epochs=None,
+                         budget_unit="sentences"):
+    """
+    Apply sampling as described in Sec 3, Eq 3 and 4.
+    Yields (epoch_nr, pairs) with an iterator over the (src, trg) sentence
+    pairs of each epoch, as bytes if as_bytes is set.
+    """
+    src_store, trg_store, float_weights = open_sampling_inputs(bitext_src, bitext_trg,
+                                                               weights_file, permutation,
+                                                               cache_weights)
+    token_counts = None
+    if budget_unit == "tokens":
+        token_counts = ranked_token_counts(bitext_src, bitext_trg, permutation)
+
+    for n, selection in sampling_selections(float_weights, start_size, samp_fraction,
+                                            total_epochs, sampler, seed, epochs, token_counts):
+        yield n, epoch_pairs(src_store, trg_store, selection, as_bytes)
+
+
+def gradual_fine_tuning(bitext_src, bitext_trg, start_size, retention_rate,
+                        num_epochs, total_epochs, permutation=None, as_bytes=False,
+                        epochs=None, budget_unit="sentences"):
+    """
+    Apply gradual fine-tuning as described in Sec 3, Eq 5.
+    Yields (epoch_nr, pairs) with an iterator over the (src, trg) sentence
+    pairs of each epoch, streamed from the memory-mapped ranked bitext.
+    """
+    src_store = open_ranked_store(bitext_src, permutation)
+    trg_store = open_ranked_store(bitext_trg, permutation)
+
+    assert(len(src_store) == len(trg_store))
+
+    cumulative_tokens = None
+    if budget_unit == "tokens":
+        cumulative_tokens = cumulative_token_counts(bitext_src, bitext_trg, permutation)
+    sizes = gft_selection_sizes(len(src_store), start_size, retention_rate, num_epochs,
+                                total_epochs, cumulative_tokens)
+    for n in epochs or range(1, total_epochs+1):
+        yield n, epoch_pairs(src_store[:sizes[n - 1]], trg_store[:sizes[n - 1]],
+                             as_bytes=as_bytes)
+
+
+def write_gft_manifest(manifest_file, bitext_src, bitext_trg, start_size, retention_rate,
+                       num_epochs, total_epochs, permutation_file=None,
+                       budget_unit="sentences"):
+    """
+    Writes a JSON manifest with the number of lines of each gradual
+    fine-tuning epoch and, for uncompressed files, the byte offset at which
+    it ends.
+    """
+    permutation = load_permutation(permutation_file) if permutation_file else None
+    num_lines   = count_ranked_lines(bitext_src, permutation)
+    assert(num_lines == count_ranked_lines(bitext_trg, permutation))
+    cumulative_tokens = None
+    if budget_unit == "tokens":
+        cumulative_tokens = cumulative_token_counts(bitext_src, bitext_trg, permutation)
+    sizes = gft_selection_sizes(num_lines, start_size, retention_rate, num_epochs, total_epochs,
+                                cumulative_tokens)
+
+    epochs = [{"epoch": n + 1, "num_lines": size} for n, size in enumerate(sizes)]
+    if cumulative_tokens is not None:
+        for epoch in epochs:
+            epoch["num_tokens"] = int(cumulative_tokens[epoch["num_lines"] - 1]) \
+                                  if epoch["num_lines"] else 0
+    if permutation is None and not (compression_of(bitext_src) or compression_of(bitext_trg)):
+        src_offsets = load_line_index(bitext_src)
+        trg_offsets = load_line_index(bitext_trg)
+        for epoch in epochs:
+            epoch["src_bytes"] = int(src_offsets[epoch["num_lines"]])
+            epoch["trg_bytes"] = int(trg_offsets[epoch["num_lines"]])
+
+    manifest = {"bitext_src": os.path.abspath(bitext_src),
+                "bitext_trg": os.path.abspath(bitext_trg),
+                "permutation": os.path.abspath(permutation_file) if permutation_file else None,
+                "num_lines": num_lines,
+                "budget_unit": budget_unit,
+                "epochs": epochs}
+    with open(manifest_file, "w+") as outfile:
+        json.dump(manifest, outfile, indent=1)
+
+
+def load_gft_manifest(manifest_file):
+    """
+    Reads a manifest written by write_gft_manifest.
+    """
+    with open(manifest_file, "r") as infile:
+        return json.load(infile)
+
+
+def iter_gft_epoch(manifest, epoch_nr, as_bytes=False):
+    """
+    Yields the (src, trg) sentence pairs of a gradual fine-tuning epoch
+    from a manifest (or the path of one). Uncompressed ranked bitext files
+    are read sequentially up to the byte offsets at which the epoch ends;
+    otherwise, the first lines of the ranked bitext are read.
+    """
+    if not isinstance(manifest, dict):
+        manifest = load_gft_manifest(manifest)
+    num_epochs = len(manifest["epochs"])
+    if not (1 <= epoch_nr and epoch_nr <= num_epochs):
+        raise ValueError("Epoch %d is not in range 1-%d" %(epoch_nr, num_epochs))
+    epoch = manifest["epochs"][epoch_nr - 1]
+    if "src_bytes" in epoch and "trg_bytes" in epoch:
+        return line_pairs(iter_prefix_lines(manifest["bitext_src"], epoch["src_bytes"]),
+                          iter_prefix_lines(manifest["bitext_trg"], epoch["trg_bytes"]),
+                          as_bytes)
+
+    permutation = None
+    if manifest["permutation"]:
+        permutation = load_permutation(manifest["permutation"])
+    top_n_to_keep = epoch["num_lines"]
+    src_store     = open_ranked_store(manifest["bitext_src"], permutation)
+    trg_store     = open_ranked_store(manifest["bitext_trg"], permutation)
+    return epoch_pairs(src_store[:top_n_to_keep], trg_store[:top_n_to_keep], as_bytes=as_bytes)
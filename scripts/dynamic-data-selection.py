@@ -6,8 +6,13 @@ For details, see paper 'Dynamic Data Selection for Neural Machine Translation'.
 
 # imports
 import argparse
-import sys, random, time
-from numpy.random import choice
+import os, sys, random, time, tempfile, itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+import dds
+import epoch_server
+from bitext_io import load_permutation, open_ranked_store, open_output, copy_prefix, \
+                      compression_of, compression_threads, decompressed_path, SHARED_DIR, WRITE_BUFFER
 
 
 # functions
@@ -22,8 +27,14 @@ def parse_commandline():
                         help="Path to source file of ranked bitext")
     parser.add_argument("--bitext_trg", required=True,
                         help="Path to target file of ranked bitext")
+    parser.add_argument("--permutation", help="Path to ranked-bitext.perm written by " +
+                        "rank-bitext.py --permutation_only. If given, bitext_src and " +
+                        "bitext_trg are the original, unranked bitext files")
     parser.add_argument("--ced_weights", help="Path to file with CED weights of " +
-                        "ranked bitext (only used for sampling)")
+                        "ranked bitext, as text or binary score file (only used for sampling)")
+    parser.add_argument("--cache_weights", action="store_true",
+                        help="Convert a text CED weights file to a binary <file>.bin cache, " +
+                             "which is memory-mapped instead of parsed in later runs")
     parser.add_argument("--dds_method", required=True, choices=(["gft", "sampling"]),
                         help="Method to use for dynamic data selection")
     parser.add_argument("--alpha", type=float, default=0.5,
@@ -34,100 +45,401 @@ def parse_commandline():
     parser.add_argument("--eta", type=int, default=2,
                         help="Number of epochs to use each subset " + 
                              "(default=2, used for gft)")
+    parser.add_argument("--budget_unit", default="sentences", choices=(["sentences", "tokens"]),
+                        help="Size epochs by number of sentence pairs (sentences, default) " +
+                             "or by number of source and target tokens (tokens), so that " +
+                             "epochs have a predictable cost; for sampling, the sampling " +
+                             "fraction is then a fraction of all tokens (used for gft and " +
+                             "sampling)")
     parser.add_argument("--sampling_fraction", type=float, default=0.2, 
                         help="Fraction of complete bitext to include in each sample " + 
                              "(range 0-1, default=0.2, used for sampling)")
+    parser.add_argument("--sampler", default="es", choices=(["es", "numpy"]),
+                        help="Weighted sampling backend: O(n) random-key sampling (es, " +
+                             "default) or numpy.random.choice (numpy, used for sampling)")
     parser.add_argument("--total_epochs", type=int, default=16,
                         help="Total number of epochs to generate subsets for " +
                              "(default=16, used for gft and sampling)")
+    parser.add_argument("--gft_output", default="files", choices=(["files", "manifest"]),
+                        help="Write gft epochs as training files (files, default) or only " +
+                             "a manifest <bitext_src>.gft.json with the number of lines and " +
+                             "byte offset of each epoch in the ranked bitext (manifest)")
+    parser.add_argument("--single_pass", action="store_true",
+                        help="Draw all samples first and write all epochs in one sequential " +
+                             "pass over the ranked bitext, without loading it into memory " +
+                             "(used for sampling)")
+    parser.add_argument("--compress", choices=(["none", "gzip", "zstd"]),
+                        help="Compress the epoch files with gzip (.gz) or zstd (.zst) using " +
+                             "multiple threads (default: compress epoch files like the " +
+                             "bitext files)")
+    parser.add_argument("--tmp_dir",
+                        help="Directory for decompressed copies of compressed bitext files " +
+                             "(default: system temp directory)")
+    parser.add_argument("--seed", type=int,
+                        help="Seed for sampling; each epoch draws from its own random stream " +
+                             "derived from the seed, so results are reproducible and do not " +
+                             "depend on --workers (used for sampling)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes that sample and write epochs " +
+                             "concurrently (default=1, used for sampling)")
+    parser.add_argument("--epochs",
+                        help="Only generate these epochs, e.g. 9-16 or 1,3,5-7, to resume " +
+                             "training without regenerating earlier epochs; requires --seed " +
+                             "for sampling (default: all epochs, used for gft and sampling)")
+    parser.add_argument("--prefetch", type=int,
+                        help="Run as a producer that writes epochs in the background, at most " +
+                             "this many epochs ahead of the epoch being trained on, and " +
+                             "removes epochs once the trainer marks them as consumed with " +
+                             "train.src.<epoch>.done (used for gft and sampling)")
+    parser.add_argument("--poll_interval", type=float, default=1.0,
+                        help="Seconds between checks for consumed epochs in producer mode " +
+                             "(default=1.0)")
+    parser.add_argument("--length_buckets", type=int,
+                        help="Write each epoch grouped into buckets of sentence pairs with " +
+                             "similar length (source plus target tokens, in intervals of this " +
+                             "many tokens), from short to long and shuffled within buckets, " +
+                             "and the line at which each bucket starts to " +
+                             "train.src.<epoch>.buckets (used for gft and sampling)")
+    parser.add_argument("--serve",
+                        help="Instead of writing epoch files, serve epochs on this Unix " +
+                             "domain socket path or host:port, from which data loaders " +
+                             "stream batches of sentence pairs per epoch and shard (see " +
+                             "epoch_server.request_epoch, used for gft and sampling)")
+    parser.add_argument("--shuffle", action="store_true",
+                        help="Shuffle the sentence pairs of each served epoch, using --seed " +
+                             "(used with --serve)")
+    parser.add_argument("--batch_size", type=int, default=epoch_server.DEFAULT_BATCH_SIZE,
+                        help="Default number of sentence pairs per served batch " +
+                             "(default=%d, used with --serve)" %epoch_server.DEFAULT_BATCH_SIZE)
     return parser.parse_args()
 
 
-def normalize_weights(weights):
+def open_epoch_files(bitext_file, epochs, compression=None, buffer_size=None):
     """
-    Invert and min-max normalize CED weights as in Eq 3.
+    Opens train.<ext>.epoch for each of the given epochs, by epoch number.
+    The source and target files of all these epochs are written at the same
+    time, so they share the compression threads and, unless buffer_size is
+    given, the write buffer memory.
     """
-    max_weight   = max(weights)
-    min_weight   = min(weights)
-    norm_weights = [1.0 - ((w - min_weight) / (max_weight - min_weight)) for w in weights]
-    return norm_weights
+    threads = compression_threads(2 * len(epochs))
+    if buffer_size is None:
+        buffer_size = max(1 << 16, WRITE_BUFFER // max(1, len(epochs)))
+    return dict((n, open_output(dds.epoch_file(bitext_file, n, compression), threads,
+                                buffer_size)) for n in epochs)
 
-    
-def convert_weights_to_probabilities(weights):
+
+def write_epoch(src_store, trg_store, bitext_src, bitext_trg, epoch_nr, selection,
+                compression=None, length_buckets=None, token_counts=None, seed=None,
+                tmp_prefix="", threads=None):
+    """
+    Writes the training files of one epoch, named with tmp_prefix if given,
+    optionally ordered by length buckets.
+    """
+    if length_buckets:
+        selection, boundaries = dds.bucket_epoch(selection, token_counts, length_buckets,
+                                                 epoch_nr, seed)
+        numpy.savetxt(dds.bucket_file(bitext_src, epoch_nr), boundaries, fmt="%d")
+    for store, bitext_file in ((src_store, bitext_src), (trg_store, bitext_trg)):
+        outfile_name = dds.epoch_file(bitext_file, epoch_nr, compression)
+        outfile_name = os.path.join(os.path.dirname(outfile_name),
+                                    tmp_prefix + os.path.basename(outfile_name))
+        with open_output(outfile_name, threads) as outfile:
+            store.gather(selection).write(outfile)
+
+
+def write_epochs_single_pass(src_store, trg_store, bitext_src, bitext_trg, membership,
+                             total_epochs, compression=None, epochs=None):
     """
-    Makes sure that the weights sum to 1 as in Eq 4.
+    Writes all epochs in one sequential pass over the ranked bitext: the
+    bitext is read in blocks, and the lines of each block whose bit is set
+    for an epoch in the membership bitset (see dds.epoch_membership) are
+    appended to that epoch's files at once.
     """
-    sum_weights = sum(weights)
-    return [float(i)/sum_weights for i in weights]
+    # lines are joined per block, so the files need no large write buffers
+    epochs   = epochs or range(1, total_epochs+1)
+    src_outs = open_epoch_files(bitext_src, epochs, compression, buffer_size=1 << 16)
+    trg_outs = open_epoch_files(bitext_trg, epochs, compression, buffer_size=1 << 16)
+    try:
+        block_size = 1 << 16
+        src_blocks = src_store[:len(membership)].iter_blocks(block_size)
+        trg_blocks = trg_store[:len(membership)].iter_blocks(block_size)
+        for block_start, src_lines, trg_lines in zip(range(0, len(membership), block_size),
+                                                     src_blocks, trg_blocks):
+            bits = numpy.unpackbits(membership[block_start:block_start + block_size], axis=1,
+                                    bitorder="little")
+            for n in epochs:
+                selected = bits[:, n - 1].tolist()
+                src_outs[n].write(b"".join(itertools.compress(src_lines, selected)))
+                trg_outs[n].write(b"".join(itertools.compress(trg_lines, selected)))
+    finally:
+        for outfile in list(src_outs.values()) + list(trg_outs.values()):
+            outfile.close()
+
+
+def load_sampling_arrays(sampling_dir):
+    """
+    Memory-maps the sampling probabilities and, when sampling by tokens,
+    the token counts that were saved for worker processes.
+    """
+    sample_probs = numpy.load(os.path.join(sampling_dir, "probs.npy"), mmap_mode="r")
+    lengths_file = os.path.join(sampling_dir, "lengths.npy")
+    lengths      = numpy.load(lengths_file, mmap_mode="r") if os.path.exists(lengths_file) else None
+    return sample_probs, lengths
+
+
+def write_sampled_epoch(bitext_src, bitext_trg, sampling_dir, num_to_select, epoch_nr, seed,
+                        sampler="es", permutation_file=None, compression=None,
+                        length_buckets=None, threads=None, source_files=None):
+    """
+    Samples and writes one epoch in a worker process, reading the ranked
+    bitext from source_files (src, trg) if given.
+    """
+    src_source, trg_source = source_files or (bitext_src, bitext_trg)
+    permutation  = load_permutation(permutation_file) if permutation_file else None
+    sample_probs, lengths = load_sampling_arrays(sampling_dir)
+    selection    = dds.sample_epoch(sample_probs, num_to_select, epoch_nr, seed, sampler, lengths)
+    token_counts = None
+    if length_buckets:
+        token_counts = numpy.load(os.path.join(sampling_dir, "tokens.npy"), mmap_mode="r")
+    write_epoch(open_ranked_store(src_source, permutation),
+                open_ranked_store(trg_source, permutation), bitext_src, bitext_trg, epoch_nr,
+                selection, compression, length_buckets, token_counts, seed, threads=threads)
+
+
+def draw_sample(sampling_dir, num_to_select, epoch_nr, seed, sampler="es"):
+    """
+    Samples one epoch in a worker process and returns the selection.
+    """
+    sample_probs, lengths = load_sampling_arrays(sampling_dir)
+    return dds.sample_epoch(sample_probs, num_to_select, epoch_nr, seed, sampler, lengths)
 
 
 def sample_training_data(bitext_src, bitext_trg, weights_file, start_size, 
-                         samp_fraction, total_epochs):
+                         samp_fraction, total_epochs, permutation_file=None, cache_weights=False,
+                         sampler="es", single_pass=False, compression=None, seed=None,
+                         workers=1, epochs=None, budget_unit="sentences",
+                         length_buckets=None):
     """
     Apply sampling as described in Sec 3, Eq 3 and 4.
+    With more than one worker, epochs are sampled and written concurrently.
     """
     print("Sampling %0.1f%% of the training data for %d epochs" 
           %(100*samp_fraction, total_epochs))
-          
-    with open(bitext_src, "r") as src_in, open(bitext_trg, "r") as trg_in:
-        src_lines = src_in.readlines()
-        trg_lines = trg_in.readlines()
 
-    with open(weights_file, "r") as weights:
-        float_weights = [float(w) for w in weights]
+    permutation = load_permutation(permutation_file) if permutation_file else None
+    src_store, trg_store, float_weights = dds.open_sampling_inputs(bitext_src, bitext_trg,
+                                                                   weights_file, permutation,
+                                                                   cache_weights)
+    token_counts = None
+    if budget_unit == "tokens" or length_buckets:
+        token_counts = dds.ranked_token_counts(bitext_src, bitext_trg, permutation)
+    budget_tokens = token_counts if budget_unit == "tokens" else None
 
-    assert(len(src_lines) == len(trg_lines) and len(trg_lines) == len(float_weights))
-    
-    # absolute rather than relative hyperparam values
-    select_from   = int(start_size * len(src_lines))
-    num_to_select = int(samp_fraction * len(src_lines))
-    
-    # normalize weights
-    top_n_src     = src_lines[:select_from]
-    top_n_trg     = trg_lines[:select_from]
-    top_n_weights = float_weights[:select_from]
-    norm_weights  = normalize_weights(top_n_weights)
-    sample_probs  = convert_weights_to_probabilities(norm_weights)
-
-    # weighted sampling: draw n sentence pairs per epoch
-    for n in range(1, total_epochs+1):
-        epoch_nr = str(n)
-        selection = choice(select_from, size=num_to_select, replace=False, p=sample_probs)
-
-        # write selected sentences to train.src.epoch and train.trg.epoch
-        with open(bitext_src + "." + epoch_nr, "w+") as src_out, \
-             open(bitext_trg + "." + epoch_nr, "w+") as trg_out:
-            for sent_nr in sorted(selection):
-                src_out.write(src_lines[sent_nr])
-                trg_out.write(trg_lines[sent_nr])
+    if workers > 1:
+        if seed is None:
+            seed = numpy.random.SeedSequence().entropy
+            print("Sampling with seed %d" %seed)
+        sample_probs, num_to_select = dds.sampling_probabilities(float_weights, start_size,
+                                                                 samp_fraction)
+        epochs = epochs or range(1, total_epochs+1)
+        # workers memory-map the probabilities instead of receiving a copy each
+        with tempfile.TemporaryDirectory(prefix="dds-sampling.",
+                                         dir=SHARED_DIR) as sampling_dir, \
+             ProcessPoolExecutor(workers) as pool:
+            numpy.save(os.path.join(sampling_dir, "probs.npy"), sample_probs)
+            if budget_tokens is not None:
+                lengths, num_to_select = dds.sampling_token_budget(budget_tokens, start_size,
+                                                                   samp_fraction)
+                numpy.save(os.path.join(sampling_dir, "lengths.npy"), lengths)
+            if length_buckets and not single_pass:
+                numpy.save(os.path.join(sampling_dir, "tokens.npy"), token_counts)
+            if single_pass:
+                selections = pool.map(draw_sample, itertools.repeat(sampling_dir),
+                                      itertools.repeat(num_to_select), epochs,
+                                      itertools.repeat(seed), itertools.repeat(sampler))
+                membership = dds.epoch_membership(zip(epochs, selections), len(sample_probs),
+                                                  total_epochs)
+            else:
+                for _ in pool.map(write_sampled_epoch, itertools.repeat(bitext_src),
+                                  itertools.repeat(bitext_trg), itertools.repeat(sampling_dir),
+                                  itertools.repeat(num_to_select), epochs,
+                                  itertools.repeat(seed), itertools.repeat(sampler),
+                                  itertools.repeat(permutation_file),
+                                  itertools.repeat(compression),
+                                  itertools.repeat(length_buckets),
+                                  itertools.repeat(compression_threads(workers)),
+                                  itertools.repeat((decompressed_path(bitext_src),
+                                                    decompressed_path(bitext_trg)))):
+                    pass
+                return
+        write_epochs_single_pass(src_store, trg_store, bitext_src, bitext_trg, membership,
+                                 total_epochs, compression, epochs)
+        return
+
+    selections = dds.sampling_selections(float_weights, start_size, samp_fraction,
+                                         total_epochs, sampler, seed, epochs, budget_tokens)
+    if single_pass:
+        membership = dds.epoch_membership(selections, int(start_size * len(src_store)),
+                                          total_epochs)
+        write_epochs_single_pass(src_store, trg_store, bitext_src, bitext_trg, membership,
+                                 total_epochs, compression, epochs)
+        return
+
+    # write selected sentences to train.src.epoch and train.trg.epoch
+    for n, selection in selections:
+        write_epoch(src_store, trg_store, bitext_src, bitext_trg, n, selection, compression,
+                    length_buckets, token_counts, seed)
 
     
 def gradual_fine_tuning(bitext_src, bitext_trg, start_size, retention_rate, 
-                        num_epochs, total_epochs):
+                        num_epochs, total_epochs, permutation=None, compression=None,
+                        epochs=None, budget_unit="sentences", length_buckets=None, seed=None):
     """
     Apply gradual fine-tuning as described in Sec 3, Eq 5.
+    Uncompressed epochs are copied in the kernel; otherwise the ranked
+    bitext is read once and written block-wise to every epoch.
     """
     print("Applying gradual fine-tuning for %d epochs" %total_epochs)
-    
-    with open(bitext_src, "r") as src_in, open(bitext_trg, "r") as trg_in:
-        src_lines = src_in.readlines()
-        trg_lines = trg_in.readlines()
-    
-    assert(len(src_lines) == len(trg_lines))
-    
-    # selection fraction according to Eq 5
-    fraction_to_keep = [int(len(src_lines) * start_size * retention_rate ** (i/num_epochs)) 
-                        for i in range(total_epochs)]
-    
-    # write sentences to train.src.epoch and train.trg.epoch
-    for n in range(total_epochs):
-        epoch_nr = str(n + 1)
-        top_n_to_keep = fraction_to_keep[n]
-        with open(bitext_src + "." + epoch_nr, "w+") as src_out, \
-             open(bitext_trg + "." + epoch_nr, "w+") as trg_out:
-            for i in range(top_n_to_keep):
-                src_out.write(src_lines[i])
-                trg_out.write(trg_lines[i])        
+
+    src_store = open_ranked_store(bitext_src, permutation)
+    trg_store = open_ranked_store(bitext_trg, permutation)
+    assert(len(src_store) == len(trg_store))
+    cumulative_tokens = None
+    if budget_unit == "tokens":
+        cumulative_tokens = dds.cumulative_token_counts(bitext_src, bitext_trg, permutation)
+    fraction_to_keep = dds.gft_selection_sizes(len(src_store), start_size, retention_rate,
+                                               num_epochs, total_epochs, cumulative_tokens)
+    epochs = epochs or range(1, total_epochs+1)
+
+    if length_buckets:
+        token_counts = dds.ranked_token_counts(bitext_src, bitext_trg, permutation)
+        for n in epochs:
+            write_epoch(src_store, trg_store, bitext_src, bitext_trg, n,
+                        numpy.arange(fraction_to_keep[n - 1]), compression, length_buckets,
+                        token_counts, seed)
+        return
+
+    bitext_files = (bitext_src, bitext_trg)
+    compressed   = any(compression_of(dds.epoch_file(bitext_file, 1, compression))
+                       or compression_of(bitext_file) for bitext_file in bitext_files)
+    if permutation is None and not compressed:
+        for store, bitext_file in zip((src_store, trg_store), bitext_files):
+            for n in epochs:
+                copy_prefix(bitext_file, dds.epoch_file(bitext_file, n),
+                            int(store.offsets[fraction_to_keep[n - 1]]))
+        return
+
+    # lines are joined per block, so the files need no large write buffers
+    src_outs = open_epoch_files(bitext_src, epochs, compression, buffer_size=1 << 16)
+    trg_outs = open_epoch_files(bitext_trg, epochs, compression, buffer_size=1 << 16)
+    try:
+        # epochs are nested prefixes, so each block is cut at the end of every epoch
+        block_size = 1 << 16
+        prefix     = max([fraction_to_keep[n - 1] for n in epochs] + [0])
+        src_blocks = src_store[:prefix].iter_blocks(block_size)
+        trg_blocks = trg_store[:prefix].iter_blocks(block_size)
+        for block_start, src_lines, trg_lines in zip(range(0, prefix, block_size),
+                                                     src_blocks, trg_blocks):
+            for n in epochs:
+                cut = fraction_to_keep[n - 1] - block_start
+                if cut > 0:
+                    src_outs[n].write(b"".join(src_lines[:cut]))
+                    trg_outs[n].write(b"".join(trg_lines[:cut]))
+    finally:
+        for outfile in list(src_outs.values()) + list(trg_outs.values()):
+            outfile.close()
+
+
+def collect_consumed_epochs(bitext_src, bitext_trg, written, compression=None):
+    """
+    Removes the training files and markers of written epochs that the
+    trainer has marked as done, and returns the epochs still in use.
+    """
+    in_use = []
+    for n in written:
+        if not os.path.exists(dds.epoch_marker(bitext_src, n, "done")):
+            in_use.append(n)
+            continue
+        for path in (dds.epoch_file(bitext_src, n, compression),
+                     dds.epoch_file(bitext_trg, n, compression),
+                     dds.bucket_file(bitext_src, n),
+                     dds.epoch_marker(bitext_src, n, "ready"),
+                     dds.epoch_marker(bitext_src, n, "done")):
+            if os.path.exists(path):
+                os.remove(path)
+    return in_use
+
+
+def produce_epochs(src_store, trg_store, bitext_src, bitext_trg, selections, epochs, prefetch,
+                   compression=None, poll_interval=1.0, length_buckets=None, token_counts=None,
+                   seed=None):
+    """
+    Producer mode: writes each epoch once fewer than prefetch epochs are
+    waiting, announces it with train.src.<epoch>.ready and removes it after
+    the trainer creates train.src.<epoch>.done.
+    """
+    # markers left behind by an earlier run would announce epochs too early
+    for n in epochs:
+        for state in ("ready", "done"):
+            if os.path.exists(dds.epoch_marker(bitext_src, n, state)):
+                os.remove(dds.epoch_marker(bitext_src, n, state))
+
+    written = []
+    for n, selection in selections:
+        while True:
+            written = collect_consumed_epochs(bitext_src, bitext_trg, written, compression)
+            if len(written) <= prefetch:
+                break
+            time.sleep(poll_interval)
+
+        # write under temporary names, so that the trainer never sees partial files
+        write_epoch(src_store, trg_store, bitext_src, bitext_trg, n, selection, compression,
+                    length_buckets, token_counts, seed, tmp_prefix=".tmp.")
+        for bitext_file in (bitext_src, bitext_trg):
+            outfile_name = dds.epoch_file(bitext_file, n, compression)
+            os.replace(os.path.join(os.path.dirname(outfile_name),
+                                    ".tmp." + os.path.basename(outfile_name)), outfile_name)
+        open(dds.epoch_marker(bitext_src, n, "ready"), "w").close()
+        print("Epoch %d ready" %n)
+        written.append(n)
+
+    while written:
+        time.sleep(poll_interval)
+        written = collect_consumed_epochs(bitext_src, bitext_trg, written, compression)
+
+
+def open_epoch_selection(options, permutation=None, budget_tokens=None,
+                         cumulative_tokens=None):
+    """
+    Opens the ranked bitext for serving or producing epochs and returns
+    (src_store, trg_store, select_epoch), where select_epoch(n) returns the
+    ranks of the sentence pairs selected in epoch n, for gradual fine-tuning
+    or for sampling with options.seed.
+    """
+    if options.dds_method == "gft":
+        src_store = open_ranked_store(options.bitext_src, permutation)
+        trg_store = open_ranked_store(options.bitext_trg, permutation)
+        assert(len(src_store) == len(trg_store))
+        sizes = dds.gft_selection_sizes(len(src_store), options.alpha, options.beta,
+                                        options.eta, options.total_epochs, cumulative_tokens)
+        return src_store, trg_store, lambda n: numpy.arange(sizes[n - 1])
+
+    if not options.ced_weights:
+        exit("Quitting program: CED weights file not provided.")
+    src_store, trg_store, float_weights = dds.open_sampling_inputs(options.bitext_src,
+                                                                   options.bitext_trg,
+                                                                   options.ced_weights,
+                                                                   permutation,
+                                                                   options.cache_weights)
+    sample_probs, num_to_select = dds.sampling_probabilities(float_weights, options.alpha,
+                                                             options.sampling_fraction)
+    lengths = None
+    if budget_tokens is not None:
+        lengths, num_to_select = dds.sampling_token_budget(budget_tokens, options.alpha,
+                                                           options.sampling_fraction)
+    return src_store, trg_store, lambda n: dds.sample_epoch(sample_probs, num_to_select, n,
+                                                            options.seed, options.sampler,
+                                                            lengths)
 
 
 # run program
@@ -141,6 +453,13 @@ def main():
     num_epochs     = options.eta
     samp_fraction  = options.sampling_fraction 
     total_epochs   = options.total_epochs 
+    permutation    = None
+    epochs         = None
+    token_counts   = None
+    budget_tokens  = None
+    cumulative_tokens = None
+    if options.permutation:
+        permutation = load_permutation(options.permutation)
   
     # sanity checks
     if not (0.0 <= start_size and start_size <= 1.0):
@@ -149,17 +468,75 @@ def main():
         exit("Quitting program: Retention rate beta should be in range 0.0-1.0")
     if not (0.0 <= samp_fraction and samp_fraction <= 1.0):
         exit("Quitting program: Sampling fraction should be in range 0.0-1.0")
+    if options.prefetch is not None and options.prefetch < 0:
+        exit("Quitting program: Prefetch should be at least 0")
+    if options.epochs:
+        try:
+            epochs = dds.parse_epochs(options.epochs, total_epochs)
+        except ValueError as error:
+            exit("Quitting program: Invalid --epochs (%s)" %error)
+        if options.dds_method == "sampling" and options.seed is None:
+            exit("Quitting program: --epochs requires --seed for sampling, " +
+                 "so that the selected epochs are the same as in a full run")
+    if options.length_buckets is not None:
+        if options.length_buckets < 1:
+            exit("Quitting program: Length bucket width should be at least 1")
+        if options.single_pass or options.serve:
+            exit("Quitting program: --length_buckets cannot be combined with " +
+                 "--single_pass or --serve")
  
     # dynamic data selection
     dds_method  = options.dds_method
-    if dds_method == "gft":
+    if options.tmp_dir and not (dds_method == "gft" and options.gft_output == "manifest"):
+        # opening a store later finds the copies made here
+        for bitext_file in (bitext_src, bitext_trg):
+            decompressed_path(bitext_file, options.tmp_dir)
+    if (options.budget_unit == "tokens" or options.length_buckets) and \
+       (options.serve or options.prefetch is not None):
+        token_counts = dds.ranked_token_counts(bitext_src, bitext_trg, permutation)
+    if options.budget_unit == "tokens" and token_counts is not None:
+        budget_tokens     = token_counts
+        cumulative_tokens = numpy.cumsum(token_counts, dtype=numpy.uint64)
+    if dds_method == "gft" and options.gft_output == "manifest":
+        print("Writing gradual fine-tuning manifest for %d epochs" %total_epochs)
+        dds.write_gft_manifest(bitext_src + ".gft.json", bitext_src, bitext_trg, start_size,
+                               retention_rate, num_epochs, total_epochs, options.permutation,
+                               options.budget_unit)
+    elif options.serve:
+        if (dds_method == "sampling" or options.shuffle) and options.seed is None:
+            # all shards of an epoch must come from the same selection and order
+            options.seed = numpy.random.SeedSequence().entropy
+            print("Serving with seed %d" %options.seed)
+        src_store, trg_store, select_epoch = open_epoch_selection(options, permutation,
+                                                                  budget_tokens,
+                                                                  cumulative_tokens)
+        epochs = epoch_server.EpochSource(select_epoch, total_epochs, options.shuffle,
+                                          options.seed)
+        print("Serving %s epochs on %s" %(dds_method, options.serve))
+        epoch_server.serve_epochs(options.serve, src_store, trg_store, epochs,
+                                  options.batch_size)
+    elif options.prefetch is not None:
+        print("Producing %s epochs up to %d epochs ahead" %(dds_method, options.prefetch))
+        src_store, trg_store, select_epoch = open_epoch_selection(options, permutation,
+                                                                  budget_tokens,
+                                                                  cumulative_tokens)
+        selections = ((n, select_epoch(n)) for n in epochs or range(1, total_epochs+1))
+        produce_epochs(src_store, trg_store, bitext_src, bitext_trg, selections,
+                       epochs or range(1, total_epochs+1), options.prefetch, options.compress,
+                       options.poll_interval, options.length_buckets, token_counts,
+                       options.seed)
+    elif dds_method == "gft":
         gradual_fine_tuning(bitext_src, bitext_trg, start_size, retention_rate, 
-                            num_epochs, total_epochs)
+                            num_epochs, total_epochs, permutation, options.compress, epochs,
+                            options.budget_unit, options.length_buckets, options.seed)
     elif dds_method == "sampling":
         if not bitext_weights:
             exit("Quitting program: CED weights file not provided.")
         sample_training_data(bitext_src, bitext_trg, bitext_weights, start_size, 
-                             samp_fraction, total_epochs)
+                             samp_fraction, total_epochs, options.permutation,
+                             options.cache_weights, options.sampler, options.single_pass,
+                             options.compress, options.seed, options.workers, epochs,
+                             options.budget_unit, options.length_buckets)
 
 if __name__ == "__main__":
   main()
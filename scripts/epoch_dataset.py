@@ -0,0 +1,160 @@
+"""
+Iterable dataset over dynamic data selection epochs for multi-worker loading
+Author: Marlies van der Wees
+For details, see paper 'Dynamic Data Selection for Neural Machine Translation'.
+
+EpochDataset yields the (src, trg) sentence pairs of one epoch, read from
+the memory-mapped ranked bitext. Every data loader worker only yields its
+own contiguous slice of the epoch, e.g.:
+
+    from torch.utils.data import DataLoader
+    import epoch_dataset
+
+    dataset = epoch_dataset.EpochDataset("train.src", "train.trg", "gft")
+    loader  = DataLoader(dataset, batch_size=64, num_workers=4)
+    for epoch_nr in range(1, 17):
+        dataset.set_epoch(epoch_nr)
+        for batch in loader:
+            ...
+
+torch is optional: without it, EpochDataset is a plain iterable, and the
+worker is given with worker_id and num_workers.
+"""
+
+# imports
+import numpy
+import dds
+from bitext_io import open_ranked_store, load_permutation, decompressed_path, \
+                     load_line_index, load_token_counts, load_scores
+try:
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:
+    IterableDataset = object
+    get_worker_info = None
+
+
+# classes
+class EpochDataset(IterableDataset):
+    """
+    Sentence pairs of one DDS epoch (gft or sampling, see dds.py), sharded
+    over data loader workers. The inputs are prepared when the dataset is
+    created and opened lazily in each worker; seed is drawn once if not
+    given, so that all workers agree on each epoch.
+    """
+    def __init__(self, bitext_src, bitext_trg, dds_method="gft", epoch=1, start_size=0.5,
+                 retention_rate=0.7, num_epochs=2, total_epochs=16, budget_unit="sentences",
+                 weights_file=None, samp_fraction=0.2, sampler="es", seed=None,
+                 permutation_file=None, cache_weights=False, shuffle=False, worker_id=None,
+                 num_workers=None, as_bytes=False, tmp_dir=None):
+        if dds_method not in ("gft", "sampling"):
+            raise ValueError("Unknown dds_method %s" %dds_method)
+        if dds_method == "sampling" and not weights_file:
+            raise ValueError("Sampling requires a CED weights file")
+        if seed is None:
+            seed = numpy.random.SeedSequence().entropy
+        self.bitext_src       = decompressed_path(bitext_src, tmp_dir)
+        self.bitext_trg       = decompressed_path(bitext_trg, tmp_dir)
+        for bitext_file in (self.bitext_src, self.bitext_trg):
+            load_line_index(bitext_file)
+            if budget_unit == "tokens":
+                load_token_counts(bitext_file)
+        if dds_method == "sampling" and cache_weights:
+            load_scores(weights_file, cache=True)
+        self.dds_method       = dds_method
+        self.start_size       = start_size
+        self.retention_rate   = retention_rate
+        self.num_epochs       = num_epochs
+        self.total_epochs     = total_epochs
+        self.budget_unit      = budget_unit
+        self.weights_file     = weights_file
+        self.samp_fraction    = samp_fraction
+        self.sampler          = sampler
+        self.seed             = seed
+        self.permutation_file = permutation_file
+        self.cache_weights    = cache_weights
+        self.shuffle          = shuffle
+        self.worker_id        = worker_id
+        self.num_workers      = num_workers
+        self.as_bytes         = as_bytes
+        self.inputs           = None
+        self.set_epoch(epoch)
+
+    def __getstate__(self):
+        # memory maps are not pickled; each worker opens its own
+        state = self.__dict__.copy()
+        state["inputs"] = None
+        return state
+
+    def set_epoch(self, epoch_nr):
+        if not (1 <= epoch_nr and epoch_nr <= self.total_epochs):
+            raise ValueError("Epoch %d is not in range 1-%d" %(epoch_nr, self.total_epochs))
+        self.epoch = epoch_nr
+
+    def open_inputs(self):
+        """
+        Opens the ranked bitext and, for sampling, the sampling
+        probabilities, once per process.
+        """
+        if self.inputs is None:
+            permutation = None
+            if self.permutation_file:
+                permutation = load_permutation(self.permutation_file)
+            if self.dds_method == "gft":
+                src_store = open_ranked_store(self.bitext_src, permutation)
+                trg_store = open_ranked_store(self.bitext_trg, permutation)
+                assert(len(src_store) == len(trg_store))
+                cumulative_tokens = None
+                if self.budget_unit == "tokens":
+                    cumulative_tokens = dds.cumulative_token_counts(self.bitext_src,
+                                                                    self.bitext_trg, permutation)
+                self.inputs = src_store, trg_store, cumulative_tokens, None, None
+            else:
+                src_store, trg_store, float_weights = dds.open_sampling_inputs(
+                    self.bitext_src, self.bitext_trg, self.weights_file, permutation,
+                    self.cache_weights)
+                sample_probs, num_to_select = dds.sampling_probabilities(
+                    float_weights, self.start_size, self.samp_fraction)
+                lengths = None
+                if self.budget_unit == "tokens":
+                    token_counts = dds.ranked_token_counts(self.bitext_src, self.bitext_trg,
+                                                           permutation)
+                    lengths, num_to_select = dds.sampling_token_budget(
+                        token_counts, self.start_size, self.samp_fraction)
+                self.inputs = src_store, trg_store, sample_probs, num_to_select, lengths
+        return self.inputs
+
+    def selection(self, epoch_nr):
+        """
+        Ranks of the sentence pairs of an epoch, in the order they are
+        yielded.
+        """
+        if self.dds_method == "gft":
+            src_store, trg_store, cumulative_tokens = self.open_inputs()[:3]
+            sizes     = dds.gft_selection_sizes(len(src_store), self.start_size,
+                                                self.retention_rate, self.num_epochs,
+                                                self.total_epochs, cumulative_tokens)
+            selection = numpy.arange(sizes[epoch_nr - 1])
+        else:
+            src_store, trg_store, sample_probs, num_to_select, lengths = self.open_inputs()
+            selection = dds.sample_epoch(sample_probs, num_to_select, epoch_nr, self.seed,
+                                         self.sampler, lengths)
+        if self.shuffle:
+            selection = dds.shuffle_epoch(selection, epoch_nr, self.seed)
+        return selection
+
+    def worker(self):
+        """
+        Returns (worker_id, num_workers) of the current process.
+        """
+        if self.worker_id is not None or self.num_workers is not None:
+            return self.worker_id or 0, self.num_workers or 1
+        worker_info = get_worker_info() if get_worker_info else None
+        if worker_info is None:
+            return 0, 1
+        return worker_info.id, worker_info.num_workers
+
+    def __iter__(self):
+        src_store, trg_store = self.open_inputs()[:2]
+        selection  = self.selection(self.epoch)
+        start, end = dds.shard_bounds(len(selection), *self.worker())
+        return dds.epoch_pairs(src_store, trg_store, selection[start:end], self.as_bytes)
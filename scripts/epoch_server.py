@@ -0,0 +1,184 @@
+"""
+Local server that streams dynamic data selection epochs to data loaders
+Author: Marlies van der Wees
+For details, see paper 'Dynamic Data Selection for Neural Machine Translation'.
+
+The server keeps one memory-mapped ranked bitext open and streams the
+sentence pairs of a requested epoch and shard in batches, so that trainers
+never read epoch files, e.g.:
+
+    import epoch_server
+    for batch in epoch_server.request_epoch("/tmp/dds.sock", epoch_nr,
+                                            shard=worker_id, num_shards=num_workers):
+        for src, trg in batch:
+            ...
+
+Protocol: the client sends one JSON line {"epoch", "shard", "num_shards",
+"batch_size"}. The server answers with one JSON line, {"num_pairs"} or
+{"error"}, followed by batches of a BATCH_HEADER (number of pairs, source
+bytes, target bytes) and the newline-terminated source and target lines,
+and a header with zero pairs after the last batch.
+"""
+
+# imports
+import json, os, socket, socketserver, stat, struct, threading
+import dds
+
+
+# constants
+BATCH_HEADER = struct.Struct("<IQQ")
+DEFAULT_BATCH_SIZE = 1000
+
+
+# functions
+def parse_address(address):
+    """
+    Returns (host, port) for an address "host:port", or the path of a Unix
+    domain socket.
+    """
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit() and "/" not in address:
+        return host, int(port)
+    return address
+
+
+class EpochSource(object):
+    """
+    Selects the sentence pairs of an epoch, optionally shuffled, and splits
+    them into shards. The selection of the most recent epochs is kept, so
+    that the shards of an epoch requested by several workers are computed
+    once and are disjoint.
+    """
+    def __init__(self, select_epoch, total_epochs, shuffle=False, seed=None, cache_size=2):
+        self.select_epoch = select_epoch
+        self.total_epochs = total_epochs
+        self.shuffle      = shuffle
+        self.seed         = seed
+        self.cache_size   = cache_size
+        self.selections   = {}
+        self.lock         = threading.Lock()
+
+    def selection(self, epoch_nr):
+        if not (1 <= epoch_nr and epoch_nr <= self.total_epochs):
+            raise ValueError("Epoch %d is not in range 1-%d" %(epoch_nr, self.total_epochs))
+        with self.lock:
+            if epoch_nr not in self.selections:
+                selection = self.select_epoch(epoch_nr)
+                if self.shuffle:
+                    selection = dds.shuffle_epoch(selection, epoch_nr, self.seed)
+                if len(self.selections) >= self.cache_size:
+                    del self.selections[min(self.selections)]
+                self.selections[epoch_nr] = selection
+            return self.selections[epoch_nr]
+
+    def shard(self, epoch_nr, shard=0, num_shards=1):
+        selection  = self.selection(epoch_nr)
+        start, end = dds.shard_bounds(len(selection), shard, num_shards)
+        return selection[start:end]
+
+
+class EpochRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Streams the batches of one epoch shard per connection.
+    """
+    def handle(self):
+        try:
+            request    = json.loads(self.rfile.readline())
+            batch_size = int(request.get("batch_size") or self.server.batch_size)
+            selection  = self.server.epochs.shard(int(request["epoch"]),
+                                                  int(request.get("shard", 0)),
+                                                  int(request.get("num_shards", 1)))
+        except (ValueError, KeyError, TypeError) as error:
+            self.wfile.write((json.dumps({"error": str(error)}) + "\n").encode())
+            return
+        self.wfile.write((json.dumps({"num_pairs": len(selection)}) + "\n").encode())
+
+        src_lines = self.server.src_store.gather(selection).iter_blocks(max(1, batch_size))
+        trg_lines = self.server.trg_store.gather(selection).iter_blocks(max(1, batch_size))
+        for src_batch, trg_batch in zip(src_lines, trg_lines):
+            src_bytes = b"".join(src_batch)
+            trg_bytes = b"".join(trg_batch)
+            self.wfile.write(BATCH_HEADER.pack(len(src_batch), len(src_bytes), len(trg_bytes)))
+            self.wfile.write(src_bytes)
+            self.wfile.write(trg_bytes)
+        self.wfile.write(BATCH_HEADER.pack(0, 0, 0))
+
+
+class UnixEpochServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class TCPEpochServer(socketserver.ThreadingTCPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+
+def serve_epochs(address, src_store, trg_store, epochs, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Serves the epochs of an EpochSource from the PackedLines stores of the
+    ranked bitext on a Unix domain socket or localhost port, handling each
+    connection in its own thread, until interrupted. A socket left behind at
+    the path of a Unix domain socket is replaced; any other file is not.
+    """
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        server_class = TCPEpochServer
+    else:
+        server_class = UnixEpochServer
+        if os.path.exists(address):
+            if not stat.S_ISSOCK(os.stat(address).st_mode):
+                exit("Quitting program: %s exists and is not a socket" %address)
+            os.remove(address)
+    with server_class(address, EpochRequestHandler) as server:
+        server.src_store  = src_store
+        server.trg_store  = trg_store
+        server.epochs     = epochs
+        server.batch_size = batch_size
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if not isinstance(address, tuple):
+                os.remove(address)
+
+
+def read_exactly(infile, num_bytes):
+    data = infile.read(num_bytes)
+    if len(data) < num_bytes:
+        raise IOError("Connection to epoch server closed before the end of the epoch")
+    return data
+
+
+def request_epoch(address, epoch_nr, shard=0, num_shards=1, batch_size=None, as_bytes=False):
+    """
+    Yields the batches of one shard of an epoch from an epoch server, each
+    as a list of (src, trg) sentence pairs, decoded from UTF-8 unless
+    as_bytes is set. Shards 0 to num_shards-1 of an epoch are disjoint and
+    together contain all of its sentence pairs.
+    """
+    address = parse_address(address)
+    family  = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+    with socket.socket(family, socket.SOCK_STREAM) as connection:
+        connection.connect(address)
+        request = {"epoch": epoch_nr, "shard": shard, "num_shards": num_shards,
+                   "batch_size": batch_size}
+        connection.sendall((json.dumps(request) + "\n").encode())
+        with connection.makefile("rb") as infile:
+            reply = json.loads(infile.readline() or "{}")
+            if "error" in reply or "num_pairs" not in reply:
+                raise ValueError("Epoch server refused request: %s"
+                                 %reply.get("error", "no reply"))
+            while True:
+                num_pairs, src_size, trg_size = BATCH_HEADER.unpack(
+                    read_exactly(infile, BATCH_HEADER.size))
+                if num_pairs == 0:
+                    break
+                src_lines = read_exactly(infile, src_size).split(b"\n")[:-1]
+                trg_lines = read_exactly(infile, trg_size).split(b"\n")[:-1]
+                if as_bytes:
+                    yield [(src + b"\n", trg + b"\n") for src, trg in zip(src_lines, trg_lines)]
+                else:
+                    yield [(src.decode("utf-8", "replace") + "\n",
+                            trg.decode("utf-8", "replace") + "\n")
+                           for src, trg in zip(src_lines, trg_lines)]
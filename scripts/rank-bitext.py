@@ -1,4 +1,10 @@
 import argparse
+import itertools, os, tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy
+from bitext_io import load_line_index, PackedLines, open_output, write_permutation, load_permutation, \
+                      load_scores_parallel, iter_score_blocks, write_scores, source_hash, \
+                      count_lines, decompressed_path, compression_threads, output_path, SCAN_CHUNK
 
 def parse_commandline():
     """
@@ -22,53 +28,323 @@ def parse_commandline():
     parser.add_argument("--trg_general_loss", required=True,
                         help="Path to sentence-level cross-entropy scores with " +\
                              "general-domain target LM")
+    parser.add_argument("--score_dtype", default="float64", choices=(["float32", "float64"]),
+                        help="Floating point type used to hold the loss scores " +\
+                             "(default=float64)")
+    parser.add_argument("--memory_budget",
+                        help="Rank out-of-core within roughly this much memory, " +\
+                             "e.g. 4G or 512M (default: rank in memory)")
+    parser.add_argument("--tmp_dir",
+                        help="Directory for temporary sorted runs in out-of-core mode and " +\
+                             "decompressed copies of compressed bitext files " +\
+                             "(default: system temp directory)")
+    parser.add_argument("--permutation_only", action="store_true",
+                        help="Only write the ranking as ranked-bitext.perm (sentence ids " +\
+                             "in ranked order) instead of <file>.ranked copies of the bitext")
+    parser.add_argument("--cache_scores", action="store_true",
+                        help="Convert text loss files to binary <file>.bin caches, " +\
+                             "which are memory-mapped instead of parsed in later runs")
+    parser.add_argument("--weights_format", default="text", choices=(["text", "binary"]),
+                        help="Write weights as text (ranked-bitext.weights, default) or " +\
+                             "as binary float32 scores (ranked-bitext.weights.bin)")
+    parser.add_argument("--top_k", type=int,
+                        help="Only rank and write the k most domain-relevant sentences")
+    parser.add_argument("--keep_fraction", type=float,
+                        help="Only rank and write this fraction (range 0-1) of the most " +\
+                             "domain-relevant sentences, e.g. the alpha used for DDS")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes; with more than one, loss files " +\
+                             "are parsed in parallel and all bitext files are indexed and " +\
+                             "written in parallel (default=1)")
+    parser.add_argument("--compress", choices=(["none", "gzip", "zstd"]),
+                        help="Compress the ranked bitext files and text weights with gzip " +\
+                             "(.gz) or zstd (.zst) using multiple threads (default: compress " +\
+                             "outputs like the corresponding input files)")
     return parser.parse_args()
 
-def compute_bilingual_ced_diff(src_domain_loss, trg_domain_loss, src_general_loss, trg_general_loss):
+def parse_size(size):
+    """
+    Converts a size such as 512M or 4G to a number of bytes.
+    """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size  = size.strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def head_size(num_sentences, top_k=None, keep_fraction=None):
+    """
+    Number of top-ranked sentences to keep given --top_k or --keep_fraction.
+    """
+    if top_k is not None:
+        return min(top_k, num_sentences)
+    if keep_fraction is not None:
+        return int(keep_fraction * num_sentences)
+    return num_sentences
+
+def top_k_sent_ids(scores, k):
+    """
+    Returns the ids of the k lowest scores in sorted order, using partial
+    selection so that only the head is fully sorted. Ties are ordered by
+    sent_id as in a full stable sort.
+    """
+    if k == 0:
+        return numpy.empty(0, dtype=numpy.int64)
+    if k >= len(scores):
+        return numpy.argsort(scores, kind="stable")
+    # the k-th score may be shared by sentences inside and outside the head,
+    # keep the ones with the lowest sent_id like a stable sort would
+    kth_score = scores[numpy.argpartition(scores, k - 1)[:k]].max()
+    head_ids  = numpy.flatnonzero(scores < kth_score)
+    tie_ids   = numpy.flatnonzero(scores == kth_score)[:k - len(head_ids)]
+    head_ids  = numpy.sort(numpy.concatenate((head_ids, tie_ids)))
+    return head_ids[numpy.argsort(scores[head_ids], kind="stable")]
+
+def compute_bilingual_ced_diff(src_domain_loss, trg_domain_loss, src_general_loss, trg_general_loss,
+                               dtype="float64", cache_scores=False, top_k=None, keep_fraction=None,
+                               workers=1):
     """
     Computes difference between in-domain and general-domain loss score.
-    Returns list of tuples (score, sent_id).
+    Returns (sorted_scores, sorted_sent_ids, max_score, num_sentences).
+    """
+    try:
+        sd, td, sg, tg = load_scores_parallel([src_domain_loss, trg_domain_loss,
+                                               src_general_loss, trg_general_loss],
+                                              dtype, cache_scores, workers)
+    except ValueError as error:
+        exit("Exiting... %s" %error)
+
+    combined_scores = (sd - sg) + (td - tg)
+    num_sentences   = len(combined_scores)
+    sorted_sent_ids = top_k_sent_ids(combined_scores, head_size(num_sentences, top_k, keep_fraction))
+    max_score       = combined_scores.max() if num_sentences else None
+    return combined_scores[sorted_sent_ids], sorted_sent_ids, max_score, num_sentences
+
+# bytes of Python objects and index arrays per line read by PackedLines.iter_blocks
+LINE_OVERHEAD = 384
+
+# record layout of the sorted runs written in out-of-core mode
+RUN_DTYPE = numpy.dtype([("score", numpy.float64), ("sent_id", numpy.uint64)])
+
+def run_line_cost(dtype):
+    """
+    Bytes per sentence while a sorted run is built: the block of each loss
+    file and the next one being parsed, the score differences, the sort
+    order with its merge buffer, and the run records.
+    """
+    return 7 * numpy.dtype(dtype).itemsize + 12 + RUN_DTYPE.itemsize
+
+# bytes per buffered record while merging: the buffer of each run, the records
+# taken from it, their scores and sort order, and the sorted output block
+MERGE_RECORD_COST = 4 * RUN_DTYPE.itemsize + 16
+
+def compute_bilingual_ced_diff_external(src_domain_loss, trg_domain_loss, src_general_loss,
+                                        trg_general_loss, memory_budget, work_dir,
+                                        dtype="float64", top_k=None, keep_fraction=None):
+    """
+    Out-of-core version of compute_bilingual_ced_diff: sorted runs that fit
+    in memory_budget are spilled to work_dir and merged.
+    """
+    # a quarter of the budget for reading the loss files, the rest for the runs
+    chunk_size = max(1 << 12, min(SCAN_CHUNK, memory_budget // 64))
+    run_length = max(1, 3 * memory_budget // (4 * run_line_cost(dtype)))
+    try:
+        run_files, max_score, sent_id = write_sorted_runs(
+            (src_domain_loss, trg_domain_loss, src_general_loss, trg_general_loss),
+            run_length, chunk_size, work_dir, dtype)
+    except ValueError as error:
+        exit("Exiting... %s" %error)
+
+    print("Merging %d sorted runs of %d scores" %(len(run_files), sent_id))
+    merged_file = os.path.join(work_dir, "merged")
+    block_size  = max(1, memory_budget // (MERGE_RECORD_COST * max(1, len(run_files))))
+    num_to_keep = head_size(sent_id, top_k, keep_fraction)
+    merge_runs(run_files, merged_file, block_size, num_to_keep)
+    for run_file in run_files:
+        os.remove(run_file)
+
+    if num_to_keep == 0:
+        records = numpy.empty(0, dtype=RUN_DTYPE)
+    else:
+        records = numpy.memmap(merged_file, dtype=RUN_DTYPE, mode="r")
+    return records["score"], records["sent_id"], max_score, sent_id
+
+def write_sorted_runs(loss_files, run_length, chunk_size, work_dir, dtype="float64"):
+    """
+    Reads the four loss files in blocks of run_length scores and writes the
+    combined scores of each block, sorted, as a run of RUN_DTYPE records to
+    work_dir. Returns the run files, the maximum score and the number of
+    sentences.
     """
-    loss_scores = []
-    with open(src_domain_loss, "r") as src_domain, open(trg_domain_loss, "r") as trg_domain, \
-         open(src_general_loss, "r") as src_general, open(trg_general_loss, "r") as trg_general:
-        
-        sent_id = 0
-        for sd, td, sg, tg in zip(src_domain, trg_domain, src_general, trg_general):
-            combined_score = (float(sd) - float(sg)) + (float(td) - float(tg))
-            loss_scores.append((combined_score, sent_id))
-            sent_id += 1
+    run_files = []
+    sent_id   = 0
+    max_score = None
+    loss_runs = [iter_score_blocks(f, run_length, dtype, chunk_size) for f in loss_files]
+    for sd, td, sg, tg in itertools.zip_longest(*loss_runs):
+        if any(block is None for block in (sd, td, sg, tg)) or \
+           not len(sd) == len(td) == len(sg) == len(tg):
+            exit("Exiting... Loss files do not have the same number of lines")
 
-    return (sorted(loss_scores))
+        scores = (sd - sg) + (td - tg)
+        order  = numpy.argsort(scores, kind="stable")
+        run    = numpy.empty(len(order), dtype=RUN_DTYPE)
+        run["score"]   = scores[order]
+        run["sent_id"] = order + sent_id
+        if len(run) and (max_score is None or run["score"][-1] > max_score):
+            max_score = run["score"][-1]
+        run_files.append(os.path.join(work_dir, "run.%d" %len(run_files)))
+        run.tofile(run_files[-1])
+        sent_id += len(run)
+        del scores, order, run
+    return run_files, max_score, sent_id
+
+def read_run(run_file, block_size):
+    """
+    Yields the records of a sorted run in blocks of block_size.
+    """
+    offset = 0
+    while True:
+        block = numpy.fromfile(run_file, dtype=RUN_DTYPE, count=block_size,
+                               offset=offset * RUN_DTYPE.itemsize)
+        if not len(block):
+            break
+        yield block
+        offset += len(block)
 
-def rank_sentences(sorted_ced_diff_scores, bitext_files):
+def merge_runs(run_files, merged_file, block_size, num_to_keep):
+    """
+    Merges sorted runs into merged_file, ordered by (score, sent_id), and
+    stops after num_to_keep records.
+    """
+    readers = [read_run(run_file, block_size) for run_file in run_files]
+    buffers = [next(reader, None) for reader in readers]
+    written = 0
+    with open(merged_file, "wb") as merged:
+        while written < num_to_keep:
+            live = [i for i, buffer in enumerate(buffers) if buffer is not None]
+            if not live:
+                break
+            # buffered records up to the smallest last record of any buffer
+            # come before every record that is not buffered yet
+            last      = dict((i, (buffers[i]["score"][-1], buffers[i]["sent_id"][-1]))
+                             for i in live)
+            bound_run = min(live, key=last.get)
+            bound_score, bound_id = last[bound_run]
+            parts = []
+            for i in live:
+                buffer = buffers[i]
+                if i == bound_run:
+                    num_taken = len(buffer)
+                else:
+                    num_taken = numpy.count_nonzero((buffer["score"] < bound_score) |
+                                                    ((buffer["score"] == bound_score) &
+                                                     (buffer["sent_id"] <= bound_id)))
+                parts.append(buffer[:num_taken])
+                buffers[i] = buffer[num_taken:]
+            # runs hold increasing sent_ids, so a stable sort of the parts in
+            # run order breaks ties by sent_id
+            block = numpy.concatenate(parts)
+            del parts
+            block = block[numpy.argsort(block["score"], kind="stable")][:num_to_keep - written]
+            block.tofile(merged)
+            written += len(block)
+            del block
+            # refill the buffers that were used up only after the block is written
+            for i in live:
+                if not len(buffers[i]):
+                    buffers[i] = next(readers[i], None)
+
+def rank_sentences(sorted_scores, sorted_sent_ids, bitext_files, memory_budget=None,
+                   permutation_only=False, weights_format="text", weights_source=b"",
+                   max_score=None, num_sentences=None, workers=1, work_dir=None,
+                   compression=None):
     """
     Ranks sentences in bitext files according to sorted CED difference scores.
     Writes sorted sentences to output files.
     """
-    sorted_sentence_numbers = [i[1] for i in sorted_ced_diff_scores]
-    
+    num_scores = len(sorted_scores)
+    block_size = max(num_scores, 1) if memory_budget is None else max(1, memory_budget // 64)
+    if num_sentences is None:
+        num_sentences = num_scores
+
     # Compute 1 - min-max normalized score as weight and save weight per line to weights file
-    min_score = sorted_ced_diff_scores[0][0]
-    max_score = sorted_ced_diff_scores[-1][0]
-    normalized_ced_diff_scores = [1.0-(i[0]-min_score)/(max_score-min_score) for i in sorted_ced_diff_scores]
-    
-    with open("ranked-bitext.weights" , "w+") as weights_file:
-        for weight in normalized_ced_diff_scores:
-            weights_file.write("%0.3f\n" %weight)
-
-    # Write selected sentences in weighted order to output file
-    for bitext_file in bitext_files:
-        with open(bitext_file) as train_data:
-            train_sentences = train_data.readlines()
-            if not len(train_sentences) == len(sorted_ced_diff_scores):
-                exit("Exiting...  Bitext file %s does not have the expected number of lines " %bitext_file +\
-                     "(%d instead of %d)" %(len(train_sentences), len(sorted_ced_diff_scores)))
-        
-        outfile_name = bitext_file + ".ranked"
-        with open(outfile_name, "w+") as outfile:
-            for sent_nr in sorted_sentence_numbers:
-                outfile.write(train_sentences[sent_nr])
+    min_score = sorted_scores[0] if num_scores else None
+    if max_score is None and num_scores:
+        max_score = sorted_scores[-1]
+    normalized_ced_diff_scores = (1.0 - (sorted_scores[start:start + block_size] - min_score) /
+                                  (max_score - min_score)
+                                  for start in range(0, num_scores, block_size))
+    if weights_format == "binary":
+        write_scores("ranked-bitext.weights.bin", normalized_ced_diff_scores, weights_source)
+    else:
+        with open_output(output_path("ranked-bitext.weights", "", compression)) as weights_file:
+            for block in normalized_ced_diff_scores:
+                numpy.savetxt(weights_file, block, fmt="%0.3f")
+
+    # Index all bitext files at once, so that line counts are checked before writing;
+    # compressed files are decompressed once here and read from their copy, or only
+    # counted if no bitext is written
+    with ThreadPoolExecutor(max(1, min(workers, len(bitext_files)))) as pool:
+        if permutation_only:
+            line_counts  = list(pool.map(count_lines, bitext_files))
+        else:
+            source_files = list(pool.map(decompressed_path, bitext_files,
+                                         itertools.repeat(work_dir)))
+            line_offsets = list(pool.map(load_line_index, source_files))
+            line_counts  = [len(offsets) - 1 for offsets in line_offsets]
+    for bitext_file, num_lines in zip(bitext_files, line_counts):
+        if not num_lines == num_sentences:
+            exit("Exiting...  Bitext file %s does not have the expected number of lines " %bitext_file +\
+                 "(%d instead of %d)" %(num_lines, num_sentences))
+
+    if permutation_only:
+        write_permutation("ranked-bitext.perm", sorted_sent_ids, num_sentences)
+        return
+
+    # Write selected sentences in weighted order to output file, copying each line
+    # from the source file via its line index instead of loading the whole file
+    if workers > 1:
+        # worker processes memory-map the ranking instead of receiving a copy
+        ids_file    = os.path.join(work_dir, "ranking.npy")
+        num_workers = min(workers, len(bitext_files))
+        write_permutation(ids_file, sorted_sent_ids, num_sentences)
+        if memory_budget is not None:
+            memory_budget //= num_workers
+        with ProcessPoolExecutor(num_workers) as pool:
+            for _ in pool.map(write_ranked_file, bitext_files, itertools.repeat(ids_file),
+                              itertools.repeat(memory_budget), itertools.repeat(None),
+                              itertools.repeat(compression),
+                              itertools.repeat(compression_threads(num_workers)),
+                              source_files):
+                pass
+    else:
+        for bitext_file, offsets, source_file in zip(bitext_files, line_offsets, source_files):
+            write_ranked_file(bitext_file, sorted_sent_ids, memory_budget, offsets, compression,
+                              source_file=source_file)
+
+
+def write_ranked_file(bitext_file, sorted_sent_ids, memory_budget=None, line_offsets=None,
+                      compression=None, threads=None, source_file=None):
+    """
+    Writes the lines of bitext_file in ranked order to <bitext_file>.ranked.
+    """
+    if isinstance(sorted_sent_ids, str):
+        sorted_sent_ids = load_permutation(sorted_sent_ids)
+
+    source_lines = PackedLines.open(source_file or bitext_file, line_offsets)
+    ranked_lines = source_lines.gather(sorted_sent_ids)
+    outfile_name = output_path(bitext_file, ".ranked", compression)
+    with open_output(outfile_name, threads) as outfile:
+        if memory_budget is None:
+            ranked_lines.write(outfile)
+        else:
+            # lines per pass: each line is held twice (as bytes and in the joined
+            # block) plus its Python objects and index entries
+            num_lines      = max(len(source_lines), 1)
+            avg_line_size  = max(1, int(source_lines.offsets[-1]) // num_lines)
+            lines_per_pass = max(1, memory_budget // (2 * avg_line_size + LINE_OVERHEAD))
+            ranked_lines.write(outfile, block_size=lines_per_pass)
+    ranked_lines.close()
 
 
 if __name__ == "__main__":
@@ -81,10 +357,42 @@ if __name__ == "__main__":
     
     if len(bitext_files) < 2:
         exit("Exiting... Please specify at least two bitext files to rank")
+    if options.top_k is not None and options.keep_fraction is not None:
+        exit("Exiting... Please specify either --top_k or --keep_fraction, not both")
+    if options.top_k is not None and options.top_k < 0:
+        exit("Exiting... --top_k should be at least 0")
+    if options.keep_fraction is not None and \
+       not (0.0 <= options.keep_fraction and options.keep_fraction <= 1.0):
+        exit("Exiting... --keep_fraction should be in range 0.0-1.0")
    
-    sorted_ced_diff_scores = compute_bilingual_ced_diff(src_domain_loss, 
-                                                        trg_domain_loss, 
-                                                        src_general_loss, 
-                                                        trg_general_loss)
+    weights_source = source_hash(src_domain_loss, trg_domain_loss, src_general_loss, trg_general_loss)
+    memory_budget  = None
+    if options.memory_budget is not None:
+        memory_budget = parse_size(options.memory_budget)
+
+    with tempfile.TemporaryDirectory(prefix="rank-bitext.", dir=options.tmp_dir) as work_dir:
+        if memory_budget is None:
+            ranking = compute_bilingual_ced_diff(src_domain_loss, 
+                                                 trg_domain_loss, 
+                                                 src_general_loss, 
+                                                 trg_general_loss,
+                                                 options.score_dtype,
+                                                 options.cache_scores,
+                                                 options.top_k,
+                                                 options.keep_fraction,
+                                                 options.workers)
+        else:
+            ranking = compute_bilingual_ced_diff_external(src_domain_loss,
+                                                          trg_domain_loss,
+                                                          src_general_loss,
+                                                          trg_general_loss,
+                                                          memory_budget,
+                                                          work_dir,
+                                                          options.score_dtype,
+                                                          options.top_k,
+                                                          options.keep_fraction)
+        sorted_scores, sorted_sent_ids, max_score, num_sentences = ranking
 
-    rank_sentences(sorted_ced_diff_scores, bitext_files)
+        rank_sentences(sorted_scores, sorted_sent_ids, bitext_files, memory_budget,
+                       options.permutation_only, options.weights_format, weights_source,
+                       max_score, num_sentences, options.workers, work_dir, options.compress)